@@ -7,12 +7,11 @@ import struct
 import threading
 import time
 
-import imp
-vioslib = imp.load_source('vioslib', 'vioslib.py')
+import vioslib
 
+# listings come from the directory cache shared with other apps
 def get_subdirectories(path):
-    return [name for name in os.listdir(path)
-            if os.path.isdir(os.path.join(path, name.lower())) and name != '__pycache__']
+    return list(vioslib.directoryCache.subdirectories(path))
 
 class AudiList(vioslib.VIOSApp):
     def __init__(self, queueHandler):
@@ -20,10 +19,21 @@ class AudiList(vioslib.VIOSApp):
 
         self.name = 'AudiList'
 
+        # fixed prompts, rendered ahead of use if the engine can
+        self.prompts = ['Welcome to AudiList.',
+                        'Choose command, List, or Exit.',
+                        'Returning to root.',
+                        'Returning to parent.',
+                        'Choose node name.',
+                        'Finished recording.',
+                        'Confirm clear.',
+                        'Cleared audio.',
+                        'Leaving AudiList.']
+
     def cleanup(self):
         vioslib.VIOSApp.cleanup(self)  
 
-    def run(self, queueHandler):
+    def run(self):
         vioslib.VIOSApp.run(self)
 
         vioslib.log_msg('Registered AudiList as {0}.'.format(self.instanceId))
@@ -36,6 +46,7 @@ class AudiList(vioslib.VIOSApp):
         self.synthesize('Welcome to AudiList.')
 
         currentNode = os.path.dirname(os.path.realpath(__file__))
+        next_choice = None
         while self.interrupted == False:
             # start with always-valid choices
             choices = ['root', 'parent',
@@ -47,7 +58,15 @@ class AudiList(vioslib.VIOSApp):
             child_nodes = get_subdirectories(currentNode)
             choices.extend(child_nodes)
 
-            choice = self.grammar_prompt_and_read(choices, 'Choose command, List, or Exit.')
+            # warm the cache for whichever node is chosen next
+            vioslib.directoryCache.prefetch(currentNode)
+
+            # a choice heard while listing is handled without prompting again
+            if next_choice != None:
+                choice = next_choice
+                next_choice = None
+            else:
+                choice = self.grammar_prompt_and_read(choices, 'Choose command, List, or Exit.')
 
             if choice == 'root':
                 self.synthesize('Returning to root.')
@@ -69,13 +88,16 @@ class AudiList(vioslib.VIOSApp):
 
                 if confirm == 'yes':
                     try: 
-                        os.makedirs('{0}\\{1}'.format(currentNode, node_name))
+                        os.makedirs(os.path.join(currentNode, node_name))
                     except OSError:
-                        if not os.path.isdir('{0}\\{1}'.format(currentNode, node_name)):
+                        if not os.path.isdir(os.path.join(currentNode, node_name)):
                             raise
 
                         vioslib.log_msg('Error during os.makedirs().')
 
+                    # mtime may not change within the filesystem's resolution
+                    vioslib.directoryCache.invalidate(currentNode)
+
                     self.synthesize('Created {0}'.format(node_name));
             elif choice == 'delete':
                 node_name = self.grammar_prompt_and_read([], 'Choose node name.')
@@ -89,33 +111,34 @@ class AudiList(vioslib.VIOSApp):
 
                 if confirm == 'yes':
                     try:
-                        os.rmdir('{0}\\{1}'.format(currentNode, node_name))
+                        os.rmdir(os.path.join(currentNode, node_name))
+                        vioslib.directoryCache.invalidate(currentNode)
                         self.synthesize('Deleted {0}'.format(node_name))
                     except:
                         self.synthesize('Error deleting node. Clear node first.')
             elif choice == 'record':
-                self.send_command('record', '{0}\\audiofile.wav'.format(currentNode))
+                self.send_command('record', '{0},stop'.format(os.path.join(currentNode, 'audiofile.wav')))
 
                 # request notification of recording completion
-                self.send_command('recordDone')
+                recordDone = self.send_command('recordDone', future = True)
 
                 # wait for feedback
-                result = self.read().args
+                result = recordDone.wait()
 
                 if result != 'record done':
                     raise Exception('Unexpected result ({0}) returned from recording.'.format(result))
 
                 self.synthesize('Finished recording.')
             elif choice == 'play':
-                self.send_command('play', '{0}\\audiofile.wav,1.0'.format(currentNode))
+                self.send_command('play', '{0},1.0'.format(os.path.join(currentNode, 'audiofile.wav')))
 
                 # request notification of audio completion
-                self.send_command('playerDone')
+                playerDone = self.send_command('playerDone', future = True)
 
                 # wait for audio completion or user wanting to cancel
-                result = self.read().args
+                result = self.wait_any([playerDone])
                 while result != 'player done' and result != 'break' and result != 'exit':
-                    result = self.read().args
+                    result = self.wait_any([playerDone])
             elif choice == 'clear':
                 confirm = ''
 
@@ -123,26 +146,24 @@ class AudiList(vioslib.VIOSApp):
 
                 if confirm == 'yes':
                     try:
-                        os.remove('{0}\\audiofile.wav'.format(currentNode))
+                        os.remove(os.path.join(currentNode, 'audiofile.wav'))
+                        vioslib.directoryCache.invalidate(currentNode)
                         self.synthesize('Cleared audio.')
                     except:
                         self.synthesize('Could not clear.')
             elif any(choice == node for node in child_nodes):
                 self.synthesize('Going to node {0}.'.format(choice))
-                currentNode += '\\' + choice
+                currentNode = os.path.join(currentNode, choice)
             elif choice == 'list':
-                node_str = ', '.join(str(x) for x in child_nodes)
-                if node_str != '':
-                    node_str += ', '
-                self.synthesize(node_str + 'Root, Parent, Create, Delete, Record, Play, Clear, List, Exit.')    
-                
-                list_str = ''
-                for node in child_nodes:
-                    if node != '__pycache__':
-                        list_str += node + ','
-                list_str = list_str.rstrip(',')                
-# TODO: fix list
-                self.synthesize(list_str)
+                # child nodes a page at a time, then the commands; any choice
+                #  interrupts the listing, and break just stops it
+                if len(child_nodes) > 0:
+                    next_choice = self.speak_listing(child_nodes, choices)
+
+                if next_choice == 'break':
+                    next_choice = None
+                elif next_choice == None:
+                    self.synthesize('Root, Parent, Create, Delete, Record, Play, Clear, List, Exit.')
             elif choice == 'exit' or choice == 'break':
                 self.synthesize('Leaving AudiList.')
                 self.background()
@@ -6,19 +6,26 @@ import struct
 import threading
 import time
 
-import imp
-vioslib = imp.load_source('vioslib', 'vioslib.py')
+import vioslib
 
-def get_subdirectories(path):
-    return [name for name in os.listdir(path)
-            if os.path.isdir(os.path.join(path, name.lower())) and name != '__pycache__']
+medialibrary = vioslib.load_module('medialibrary', os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                                                'medialibrary.py'))
 
-def get_subdirectories_lower(path):
-    return [name.lower() for name in os.listdir(path)
-            if os.path.isdir(os.path.join(path, name.lower())) and name != '__pycache__']
+# listings come from the media library index, or from the directory cache
+#  shared with other apps while the index is stale for path
+def get_listing(library, path):
+    listing = library.listing(path)
+    if listing != None:
+        return listing
 
-def get_files(path):
-    return [path + '\\' + fn for fn in os.listdir(path) if fn.endswith(('.mp3', 'mp4', '.wav'))]
+    return (list(vioslib.directoryCache.subdirectories(path)),
+            vioslib.directoryCache.files(path, medialibrary.AUDIO_EXTENSIONS))
+
+def get_subdirectories(library, path):
+    return get_listing(library, path)[0]
+
+def get_files(library, path):
+    return get_listing(library, path)[1]
 
 class AudiPlay(vioslib.VIOSApp):
     def __init__(self, queueHandler):
@@ -26,6 +33,20 @@ class AudiPlay(vioslib.VIOSApp):
 
         self.name = 'AudiPlay'
 
+        # fixed prompts, rendered ahead of use if the engine can
+        self.prompts = ['Welcome to Audi Play.',
+                        'Choose command, List, or Exit.',
+                        'Returning to root.',
+                        'Returning to parent.',
+                        'No audio files in node.',
+                        'Paused player.',
+                        'Stopped player.',
+                        'Nothing playing.',
+                        'Track too short to seek.',
+                        'No children nodes available.',
+                        'Root, Parent, Play, Play All, Randomize, Randomize All, Select, List, Exit.',
+                        'Leaving Audi Play.']
+
     def cleanup(self):
         vioslib.VIOSApp.cleanup(self)   
 
@@ -36,6 +57,12 @@ class AudiPlay(vioslib.VIOSApp):
 
         self.volume = 1.0
 
+        # index of audio files below the app's root, brought up to date in the background
+        # kept outside the root so writing it doesn't change the root's mtime
+        root = os.path.dirname(os.path.realpath(__file__))
+        self.library = medialibrary.MediaLibrary(root, os.path.join(vioslib.data_directory(), 'audiplay.db'))
+        self.library.scan()
+
         self.main()
 
         self.cleanup()
@@ -47,7 +74,43 @@ class AudiPlay(vioslib.VIOSApp):
 
         return enumeration
 
-    def handle_play(self, audio_files):
+    # duration of path in whole seconds from the library, or None if not known yet
+    def track_duration(self, path):
+        info = None
+        if path != None:
+            info = self.library.track_info(path)
+
+        if info == None or info[0] == None:
+            return None
+
+        return int(info[0])
+
+    # e.g. 'Title by Artist, 3 minutes 20 seconds', from the library only
+    def describe_track(self, path):
+        info = self.library.track_info(path)
+
+        title = None
+        artist = None
+        duration = None
+        if info != None:
+            duration, title, artist = info
+
+        if title == None:
+            title = os.path.splitext(os.path.basename(path))[0]
+
+        description = title
+        if artist != None:
+            description += ' by ' + artist
+
+        if duration != None:
+            minutes, seconds = divmod(int(duration), 60)
+            description += ', {0} minutes {1} seconds'.format(minutes, seconds)
+
+        return description
+
+    # audio_files may be a list or a medialibrary.Shuffle; track_started is
+    #  called with the index of each file as it starts playing
+    def handle_play(self, audio_files, track_started = None):
         if len(audio_files) == 0:
             self.synthesize('No audio files in node.')
             return
@@ -62,47 +125,89 @@ class AudiPlay(vioslib.VIOSApp):
         file_index = 0
 
         polymorphic = True
+        playerDone = None
+        current_file = None
+
+        # with an engine that supports playNext, the next file is queued while the
+        #  current one plays, so it starts without a round trip to the app
+        # nextStarted completes with 'track started' or 'next cancelled'
+        preload = self.queueHandler.preloadTracks
+        nextStarted = None
         while self.interrupted == False:
             # set basic starting choices
             if polymorphic:
-                basicNav = ['back', 'skip', 'seek', 'volume down', 'volume up', 'previous', 'next', 'pause', 'stop', 'exit', 'break']
+                basicNav = ['back', 'skip', 'seek', 'volume down', 'volume up', 'previous', 'next', 'pause', 'track', 'stop', 'exit', 'break']
             else:
                 basicNav = ['polymorphic']
 
-            setChoices = self.set_choices(basicNav)
+            self.set_choices(basicNav)
+
+            # request notification of audio completion, unless still outstanding
+            if playerDone == None or playerDone.done():
+                playerDone = self.send_command('playerDone', future = True)
+
+            completions = [playerDone]
+            if nextStarted != None:
+                completions.append(nextStarted)
 
-            # request notification of audio completion using grammar message id
-            self.send_command('playerDone', '', setChoices.messageId)
+            # wait for audio completion, the queued file starting or a grammar
+            #  command, whichever comes first
+            result = self.wait_any(completions)
 
-            # wait for feedback
-            result = self.read(setChoices.messageId, True)
+            if result == 'player done' or result == 'track started':
+                if result == 'player done':
+                    # begin playing audio file
+                    self.send_command('play', '{0},{1}'.format(audio_files[file_index], self.volume))
 
-            if result == 'player done':
-                # begin playing audio file
-                self.send_command('play', '{0},{1}'.format(audio_files[file_index], self.volume))
+                    vioslib.metrics.observe('vios_track_gap_seconds', time.time() - playerDone.resultTime)
+
+                current_file = audio_files[file_index]
+                if track_started != None:
+                    track_started(file_index)
 
                 # advance index to next file in loop
                 file_index += 1
                 if file_index > len(audio_files) - 1:
                     file_index = 0
-            elif result == 'back':
-                choices = self.enumerate_max(60).append('break')
-                choice = self.grammar_prompt_and_read(choices, '')
 
-                if choice != 'break':
-                    self.send_command('back', '{0}'.format(choice))
-            elif result == 'skip':
-                choices = self.enumerate_max(60).append('break')
+                if preload:
+                    nextStarted = self.send_command('playNext',
+                                                    '{0},{1}'.format(audio_files[file_index], self.volume),
+                                                    future = True)
+            elif result == 'next cancelled':
+                # stopped, or replaced by a 'play' after a stop
+                nextStarted = None
+            elif result == 'back' or result == 'skip':
+                # seconds, bounded by the track's length when it's known
+                limit = 60
+                duration = self.track_duration(current_file)
+                if duration != None:
+                    limit = max(1, min(limit, duration))
+
+                choices = self.enumerate_max(limit) + ['break']
                 choice = self.grammar_prompt_and_read(choices, '')
 
                 if choice != 'break':
-                    self.send_command('skip', '{0}'.format(choice))
+                    self.send_command(result, '{0}'.format(choice))
             elif result == 'seek':
-                choices = self.enumerate_max(99).append('break')
+                # the engine moves by percent times the track's length in hundreds of
+                #  seconds, rounded to a whole number, so seeking a track of 50
+                #  seconds or less does nothing
+                duration = self.track_duration(current_file)
+                if duration != None and round(duration / 100) == 0:
+                    self.synthesize('Track too short to seek.')
+                    continue
+
+                choices = self.enumerate_max(99) + ['break']
                 choice = self.grammar_prompt_and_read(choices, '')
 
                 if choice != 'break':
                     self.send_command('seek', '{0}'.format(choice))
+            elif result == 'track':
+                if current_file == None:
+                    self.synthesize('Nothing playing.')
+                else:
+                    self.synthesize(self.describe_track(current_file))
             elif result == 'volume down':
                 self.volume /= 2.0
                 if self.volume < .125:
@@ -145,7 +250,7 @@ class AudiPlay(vioslib.VIOSApp):
             elif result == 'stop' or result == 'exit' or result == 'break':
                 break
             else:
-                vioslib.log_msg('AudiPlay received unrecognized command ({0})'.format(choice))
+                vioslib.log_msg('AudiPlay received unrecognized command ({0})'.format(result))
 
         self.send_command('stop')
 
@@ -153,30 +258,36 @@ class AudiPlay(vioslib.VIOSApp):
         
         self.synthesize('Stopped player.')
 
-    def handle_randomize(self, currentNode):
-        audio_files = []
-        
-        # build randomized list of files
-        temp_files = get_files(currentNode)
-        while (len(temp_files) > 0):
-            audio_files.append(temp_files.pop(random.randrange(0, len(temp_files))))
+    def handle_randomize(self, audio_files):
+        random.shuffle(audio_files)
 
         self.handle_play(audio_files)
 
+    # shuffles node's whole subtree lazily, resuming the saved shuffle of node
+    #  from the track that was playing when it was last left
+    def handle_randomize_all(self, node):
+        shuffle = medialibrary.Shuffle(self.library, node)
+
+        self.handle_play(shuffle, shuffle.played)
+
     def main(self):
         self.synthesize('Welcome to Audi Play.')
 
         currentNode = os.path.dirname(os.path.realpath(__file__))
         while self.interrupted == False:
-            choices = ['root', 'parent', 'play', 'randomize', 'select', 'list', 'exit', 'break']
+            choices = ['root', 'parent', 'play', 'play all', 'randomize', 'randomize all',
+                       'select', 'list', 'exit', 'break']
 
             # get list of child nodes
-            child_nodes = get_subdirectories(currentNode)
-            child_nodes_lower = get_subdirectories_lower(currentNode)
+            child_nodes = get_subdirectories(self.library, currentNode)
+            child_nodes_lower = [node.lower() for node in child_nodes]
 
             # extend choices
             choices.extend(child_nodes)
 
+            # warm the cache for whichever node is chosen next
+            vioslib.directoryCache.prefetch(currentNode)
+
             choice = self.grammar_prompt_and_read(choices,
                                                   'Choose command, List, or Exit.')
 
@@ -188,51 +299,32 @@ class AudiPlay(vioslib.VIOSApp):
                 head, tail = os.path.split(currentNode)
                 currentNode = head
             elif choice == 'play':
-                self.handle_play(get_files(currentNode))
+                self.handle_play(get_files(self.library, currentNode))
+            elif choice == 'play all':
+                self.handle_play(self.library.subtree_files(currentNode))
             elif choice == 'randomize':
-                self.handle_randomize(currentNode)
+                self.handle_randomize(get_files(self.library, currentNode))
+            elif choice == 'randomize all':
+                self.handle_randomize_all(currentNode)
             elif any(choice == node for node in child_nodes_lower):
                 self.synthesize('Going to node {0}.'.format(choice))
-                currentNode += '\\' + choice
+                currentNode = os.path.join(currentNode, choice)
             elif choice == 'select':
-                # build node string with preceding indices
-                node_str = ''
-                node_choices = []
-                node_index = 1
-                for node in child_nodes:
-                    node_str += '{0} - {1}, '.format(node_index, node)
-                    node_choices.append(str(node_index))
-                    node_index += 1
-                node_str = node_str.rstrip(',')
-
-                if node_str != '':
-                    # limit grammar choices to selecting a node or breaking
-                    choices = list(node_choices)
-                    choices.extend(['break', 'exit'])
-                    grammarSet = self.set_choices(choices)
-
-                    # start synthesizing
-                    self.synthesize(node_str)
-
-                    # request notification of synthesization availability
-                    command = self.send_command('synthesisDone', '', grammarSet.messageId)
-
-                    # block for node selection, break, or synthesis completion
-                    result = self.read(grammarSet.messageId, True).args
+                if len(child_nodes) > 0:
+                    # selecting a node by its index, breaking, or moving between pages
+                    node_choices = [str(node_index + 1) for node_index in range(len(child_nodes))]
+
+                    # speak the indexed nodes a page at a time until one is chosen
+                    result = self.speak_listing(child_nodes, node_choices + ['break', 'exit'], numbered = True)
 
                     if any(result == node for node in node_choices):
-                        self.send_command('break')
                         chosen_node = child_nodes[int(result) - 1]
                         self.synthesize('Going to node {0}.'.format(chosen_node))
-                        currentNode += '\\' + chosen_node
-                    elif result == 'break' or result == 'exit':
-                        self.send_command('break')
-                    else:
-                        vioslib.log_msg('hmm command == <{0}>'.format(result))
+                        currentNode = os.path.join(currentNode, chosen_node)
                 else:
                     self.synthesize('No children nodes available.')                    
             elif choice == 'list':
-                self.synthesize('Root, Parent, Play, Randomize, Select, List, Exit.')              
+                self.synthesize('Root, Parent, Play, Play All, Randomize, Randomize All, Select, List, Exit.')              
             elif choice == 'exit' or choice == 'break':
                 self.synthesize('Leaving Audi Play.')
                 self.background()
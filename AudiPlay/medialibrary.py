@@ -0,0 +1,543 @@
+import array
+import bisect
+import collections
+import concurrent.futures
+import os
+import queue
+import random
+import sqlite3
+import threading
+import time
+
+import vioslib
+
+import viosmedia
+
+# file name extensions AudiPlay can play
+AUDIO_EXTENSIONS = ('.mp3', 'mp4', '.wav')
+
+# the index only caches the filesystem, so a database with an older schema is
+#  rebuilt by rescanning rather than migrated
+SCHEMA_VERSION = 3
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS directories (
+    key TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    parent TEXT,
+    mtime INTEGER NOT NULL,
+    files INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS directories_parent ON directories (parent);
+
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    directory TEXT NOT NULL,
+    name TEXT NOT NULL,
+    mtime INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_directory ON files (directory, name);
+
+CREATE TABLE IF NOT EXISTS metadata (
+    path TEXT PRIMARY KEY,
+    mtime INTEGER,
+    size INTEGER,
+    duration REAL,
+    title TEXT,
+    artist TEXT
+);
+
+CREATE TABLE IF NOT EXISTS shuffles (
+    key TEXT PRIMARY KEY,
+    seed INTEGER NOT NULL,
+    position INTEGER NOT NULL
+);
+'''
+
+# files handed to a metadata worker process at a time
+METADATA_BATCH = 64
+
+# directories are looked up by normalized path, so lookups match however the
+#  case of a path was spoken on case-insensitive filesystems
+def path_key(path):
+    return os.path.normcase(os.path.normpath(path))
+
+# mtime of a directory row written for a subdirectory before it is listed
+UNLISTED = -1
+
+# bounds of the keys of every directory strictly below key, for range queries
+def subtree_range(key):
+    prefix = key.rstrip(os.sep) + os.sep
+    return prefix, prefix[:-1] + chr(ord(os.sep) + 1)
+
+# lists one directory; returns None for its entries if its mtime is unchanged
+# runs on the scanner's worker threads
+def scan_directory(path, knownMtime):
+    mtime = os.stat(path).st_mtime_ns
+    if mtime == knownMtime:
+        return path, mtime, None, None
+
+    subdirectories = []
+    files = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                if entry.name != '__pycache__':
+                    subdirectories.append(entry.name)
+            elif entry.name.endswith(AUDIO_EXTENSIONS):
+                # scandir already has the stat on Windows
+                files.append((entry.name, entry.stat().st_mtime_ns))
+
+    return path, mtime, subdirectories, files
+
+# SQLite index of the audio files below root, so AudiPlay can list a directory
+#  or a whole subtree with an index lookup instead of walking the filesystem
+# track durations and tags are extracted by a process pool after each scan and
+#  cached by path and mtime; a file rewritten in place without its directory's
+#  mtime changing keeps its old entry until the directory is next relisted
+# the scanner and metadata threads write; every thread reads through its own
+#  connection
+class MediaLibrary():
+    def __init__(self, root, dbPath, workers = 8, metadataWorkers = None):
+        self.root = root
+        self.dbPath = dbPath
+        self.workers = workers
+        self.metadataWorkers = metadataWorkers
+
+        self.local = threading.local()
+
+        connection = self.connection()
+        if connection.execute('PRAGMA user_version').fetchone()[0] != SCHEMA_VERSION:
+            connection.executescript('DROP TABLE IF EXISTS directories; '
+                                     'DROP TABLE IF EXISTS files; '
+                                     'DROP TABLE IF EXISTS metadata; '
+                                     'PRAGMA user_version = {0};'.format(SCHEMA_VERSION))
+        connection.executescript(SCHEMA)
+        connection.commit()
+
+        # set when a scan may have left files without current metadata
+        self.metadataRequested = threading.Event()
+        self.metadataThread = None
+
+        # (path, recursive) of directories queued for an incremental rescan
+        self.scanQueue = queue.Queue()
+        self.scanThread = None
+
+        # items in scanQueue, so repeated requests don't queue duplicate scans
+        self.queuedPaths = set()
+        self.queueLock = threading.Lock()
+
+        # set while the scanner has nothing queued
+        self.idle = threading.Event()
+        self.idle.set()
+
+    # one connection per thread, as sqlite3 connections can't be shared
+    def connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection == None:
+            connection = sqlite3.connect(self.dbPath, timeout = 10)
+
+            # WAL lets readers query while the scanner commits
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+
+            self.local.connection = connection
+
+        return connection
+
+    # returns (subdirectory names, audio file paths) of path if the index is
+    #  current for it, or None so the caller falls back to the filesystem
+    # a stale directory under root is queued for relisting, without its subtree;
+    #  directories outside root are never indexed
+    def listing(self, path):
+        if not self.contains(path):
+            return None
+
+        key = path_key(path)
+        connection = self.connection()
+
+        row = connection.execute('SELECT mtime FROM directories WHERE key = ?', (key,)).fetchone()
+
+        try:
+            current = row != None and row[0] == os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+
+        if not current:
+            self.scan(path, recursive = False)
+            return None
+
+        subdirectories = [os.path.basename(row[0]) for row in
+                          connection.execute('SELECT path FROM directories WHERE parent = ? ORDER BY path', (key,))]
+        files = [row[0] for row in
+                 connection.execute('SELECT path FROM files WHERE directory = ? ORDER BY name', (key,))]
+
+        return subdirectories, files
+
+    # whether path is root or below it
+    def contains(self, path):
+        key = path_key(path)
+        rootKey = path_key(self.root)
+
+        return key == rootKey or key.startswith(rootKey.rstrip(os.sep) + os.sep)
+
+    # audio file paths in path and every directory below it, as last scanned
+    def subtree_files(self, path):
+        key = path_key(path)
+        low, high = subtree_range(key)
+
+        return [row[0] for row in
+                self.connection().execute('SELECT path FROM files '
+                                          'WHERE directory = ? OR (directory >= ? AND directory < ?) '
+                                          'ORDER BY directory, name',
+                                          (key, low, high))]
+
+    # (directory keys, running file counts) of path's subtree in subtree_files
+    #  order, so the file at a given rank can be found without listing the files
+    # read from the directories' stored counts, a tenth of the rows of files
+    def subtree_counts(self, path):
+        key = path_key(path)
+        low, high = subtree_range(key)
+        connection = self.connection()
+
+        # two queries, as an OR of the directory and its subtree can't be read in
+        #  key order
+        directories = []
+        counts = array.array('q')
+        total = 0
+        for query, parameters in [('key = ?', (key,)), ('key >= ? AND key < ?', (low, high))]:
+            for directory, count in connection.execute('SELECT key, files FROM directories WHERE ' + query +
+                                                       ' AND files > 0 ORDER BY key', parameters):
+                total += count
+                directories.append(directory)
+                counts.append(total)
+
+        return directories, counts
+
+    # path of the file at offset in directory's files, by name, or None
+    def file_at(self, directory, offset):
+        row = self.connection().execute('SELECT path FROM files WHERE directory = ? ORDER BY name LIMIT 1 OFFSET ?',
+                                        (directory, offset)).fetchone()
+        if row == None:
+            return None
+
+        return row[0]
+
+    # (seed, position) of the shuffle saved for path, or None
+    def load_shuffle(self, path):
+        return self.connection().execute('SELECT seed, position FROM shuffles WHERE key = ?',
+                                         (path_key(path),)).fetchone()
+
+    def save_shuffle(self, path, seed, position):
+        connection = self.connection()
+        connection.execute('INSERT OR REPLACE INTO shuffles (key, seed, position) VALUES (?, ?, ?)',
+                           (path_key(path), seed, position))
+        connection.commit()
+
+    def file_count(self):
+        return self.connection().execute('SELECT COUNT(*) FROM files').fetchone()[0]
+
+    # (duration in seconds, title, artist) of path as last extracted, or None
+    # reads only the index, never the file
+    def track_info(self, path):
+        return self.connection().execute('SELECT duration, title, artist FROM metadata WHERE path = ?',
+                                         (path,)).fetchone()
+
+    # queues an incremental rescan of path's subtree, or of path alone if not
+    #  recursive
+    def scan(self, path = None, recursive = True):
+        if path == None:
+            path = self.root
+
+        with self.queueLock:
+            # a queued scan of the subtree relists path too
+            if (path, True) in self.queuedPaths or (path, recursive) in self.queuedPaths:
+                return
+
+            self.queuedPaths.add((path, recursive))
+            self.idle.clear()
+            self.scanQueue.put((path, recursive))
+
+            if self.scanThread == None:
+                self.scanThread = threading.Thread(target = self.process_scans)
+                self.scanThread.daemon = True
+                self.scanThread.start()
+
+    def wait_idle(self, timeout = None):
+        return self.idle.wait(timeout)
+
+    def process_scans(self):
+        executor = concurrent.futures.ThreadPoolExecutor(self.workers)
+
+        while True:
+            path, recursive = self.scanQueue.get()
+
+            try:
+                self.scan_subtree(executor, path, recursive)
+            except (OSError, sqlite3.Error) as e:
+                vioslib.log_msg('MediaLibrary: scan of {0} failed: {1}'.format(path, e), vioslib.WARNING)
+
+            self.request_metadata()
+
+            with self.queueLock:
+                self.queuedPaths.discard((path, recursive))
+                if self.scanQueue.empty():
+                    self.idle.set()
+
+    # walks path's subtree with directories listed in parallel, only relisting
+    #  directories whose mtime changed since the last scan
+    # if not recursive only path is relisted; subdirectories it gains are left
+    #  unlisted until they are listed themselves
+    def scan_subtree(self, executor, path, recursive = True):
+        startTime = time.time()
+        connection = self.connection()
+
+        key = path_key(path)
+        low, high = subtree_range(key)
+
+        # what the index knows about the subtree
+        knownMtimes = {}
+        knownChildren = collections.defaultdict(list)
+        for dirKey, dirPath, parent, mtime in connection.execute('SELECT key, path, parent, mtime FROM directories '
+                                                                 'WHERE key = ? OR (key >= ? AND key < ?)',
+                                                                 (key, low, high)):
+            knownMtimes[dirKey] = mtime
+            knownChildren[parent].append(dirPath)
+
+        parentKey = None
+        if key != path_key(self.root):
+            parentKey = path_key(os.path.dirname(path))
+
+        pending = set([executor.submit(scan_directory, path, knownMtimes.get(key))])
+        parents = { path: parentKey }
+
+        scanned = 0
+        changed = 0
+        while len(pending) > 0:
+            done, pending = concurrent.futures.wait(pending, return_when = concurrent.futures.FIRST_COMPLETED)
+
+            for future in done:
+                try:
+                    dirPath, mtime, subdirectories, files = future.result()
+                except OSError:
+                    # directory vanished or became unreadable since it was listed
+                    continue
+
+                scanned += 1
+                dirKey = path_key(dirPath)
+
+                if subdirectories == None:
+                    # unchanged; its children may still have changed
+                    children = knownChildren.get(dirKey, [])
+                else:
+                    changed += 1
+                    children = [os.path.join(dirPath, name) for name in subdirectories]
+
+                    self.store_directory(connection, dirPath, parents[dirPath], mtime, files,
+                                         knownChildren.get(dirKey, []), children)
+
+                if not recursive:
+                    continue
+
+                for child in children:
+                    parents[child] = dirKey
+                    pending.add(executor.submit(scan_directory, child, knownMtimes.get(path_key(child))))
+
+            connection.commit()
+
+        vioslib.log_msg('MediaLibrary: scanned {0} directories ({1} changed) under {2} in {3:.2f}s.'.format(scanned,
+                                                                                                           changed,
+                                                                                                           path,
+                                                                                                           time.time() - startTime))
+
+    # replaces a changed directory's files and drops subdirectories that are gone
+    # new subdirectories get UNLISTED rows in the same transaction, so listing()
+    #  never sees the directory's new mtime without all of its subdirectories
+    def store_directory(self, connection, dirPath, parentKey, mtime, files, oldChildren, children):
+        dirKey = path_key(dirPath)
+
+        connection.execute('INSERT OR REPLACE INTO directories (key, path, parent, mtime, files) VALUES (?, ?, ?, ?, ?)',
+                           (dirKey, dirPath, parentKey, mtime, len(files)))
+        connection.executemany('INSERT OR IGNORE INTO directories (key, path, parent, mtime, files) VALUES (?, ?, ?, ?, 0)',
+                               [(path_key(child), child, dirKey, UNLISTED) for child in children])
+
+        connection.execute('DELETE FROM files WHERE directory = ?', (dirKey,))
+        connection.executemany('INSERT OR REPLACE INTO files (path, directory, name, mtime) VALUES (?, ?, ?, ?)',
+                               [(os.path.join(dirPath, name), dirKey, name, fileMtime) for name, fileMtime in files])
+
+        childKeys = set(path_key(child) for child in children)
+        for oldChild in oldChildren:
+            oldKey = path_key(oldChild)
+            if oldKey not in childKeys:
+                low, high = subtree_range(oldKey)
+                connection.execute('DELETE FROM directories WHERE key = ? OR (key >= ? AND key < ?)', (oldKey, low, high))
+                connection.execute('DELETE FROM files WHERE directory = ? OR (directory >= ? AND directory < ?)',
+                                   (oldKey, low, high))
+
+    def request_metadata(self):
+        self.metadataRequested.set()
+
+        if self.metadataThread == None:
+            self.metadataThread = threading.Thread(target = self.process_metadata)
+            self.metadataThread.daemon = True
+            self.metadataThread.start()
+
+    # parses headers in worker processes, so large libraries don't compete with
+    #  the apps for the interpreter
+    def process_metadata(self):
+        executor = None
+
+        while True:
+            self.metadataRequested.wait()
+            self.metadataRequested.clear()
+
+            if executor == None:
+                executor = concurrent.futures.ProcessPoolExecutor(self.metadataWorkers)
+
+            try:
+                self.extract_metadata(executor)
+            except concurrent.futures.BrokenExecutor as e:
+                vioslib.log_msg('MediaLibrary: metadata workers failed: {0}'.format(e), vioslib.WARNING)
+                executor = None
+            except sqlite3.Error as e:
+                vioslib.log_msg('MediaLibrary: metadata update failed: {0}'.format(e), vioslib.WARNING)
+
+    def extract_metadata(self, executor):
+        startTime = time.time()
+        connection = self.connection()
+
+        # files never extracted, or changed since
+        indexedMtimes = dict(connection.execute('SELECT files.path, files.mtime FROM files '
+                                                'LEFT JOIN metadata ON metadata.path = files.path '
+                                                'WHERE metadata.path IS NULL OR metadata.mtime != files.mtime'))
+        paths = list(indexedMtimes)
+
+        futures = [executor.submit(viosmedia.read_media_infos, paths[i:i + METADATA_BATCH])
+                   for i in range(0, len(paths), METADATA_BATCH)]
+
+        for future in concurrent.futures.as_completed(futures):
+            # keyed by the mtime the index holds, so the entry stays current until
+            #  the scanner sees the file change
+            connection.executemany('INSERT OR REPLACE INTO metadata (path, mtime, size, duration, title, artist) '
+                                   'VALUES (?, ?, ?, ?, ?, ?)',
+                                   [(path, indexedMtimes[path], size, duration, title, artist)
+                                    for path, mtime, size, duration, title, artist in future.result()
+                                    if mtime != None])
+            connection.commit()
+
+        connection.execute('DELETE FROM metadata WHERE path NOT IN (SELECT path FROM files)')
+        connection.commit()
+
+        if len(paths) > 0:
+            vioslib.log_msg('MediaLibrary: extracted metadata of {0} files in {1:.2f}s.'.format(len(paths),
+                                                                                               time.time() - startTime))
+
+MASK64 = (1 << 64) - 1
+
+# splitmix64 finalizer, the round function of Shuffle's permutation
+def mix64(value):
+    value = ((value ^ (value >> 30)) * 0xbf58476d1ce4e5b9) & MASK64
+    value = ((value ^ (value >> 27)) * 0x94d049bb133111eb) & MASK64
+    return value ^ (value >> 31)
+
+# a random order of the files in path's subtree that is computed one track at a
+#  time, so shuffling a huge library costs a count per directory rather than a
+#  list of every file
+# indexes like a list for handle_play; item i is the file at rank permute(i)
+#  of subtree_files' order, where permute is a keyed Feistel network over
+#  [0, len) built from the saved seed
+# the seed and the position of the current track are saved in the library, so
+#  randomizing the same node again resumes where it was left. A rescan that
+#  changes the number of files reorders the tracks not played yet
+class Shuffle():
+    # Feistel rounds; four make a pseudorandom permutation
+    ROUNDS = 4
+
+    def __init__(self, library, path):
+        self.library = library
+        self.path = path
+
+        self.directories, self.counts = library.subtree_counts(path)
+
+        saved = library.load_shuffle(path)
+        if saved == None:
+            self.seed = random.getrandbits(63)
+            self.start = 0
+        else:
+            self.seed, self.start = saved
+
+        self.set_domain()
+
+        # handle_play asks for the same few indexes more than once
+        self.recent = {}
+
+    def set_domain(self):
+        self.length = 0
+        if len(self.counts) > 0:
+            self.length = self.counts[-1]
+
+        if self.length > 0:
+            self.start %= self.length
+
+        # the network permutes the smallest even number of bits covering length
+        self.halfBits = max(1, ((self.length - 1).bit_length() + 1) // 2)
+        self.halfMask = (1 << self.halfBits) - 1
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        path = self.recent.get(index)
+        if path != None:
+            return path
+
+        if self.length == 0:
+            raise IndexError('empty shuffle')
+
+        path = self.file_at_rank(self.permute((self.start + index) % self.length))
+        if path == None:
+            # files removed by a rescan since the counts were taken
+            self.directories, self.counts = self.library.subtree_counts(self.path)
+            self.set_domain()
+            self.recent = {}
+
+            if self.length == 0:
+                raise IndexError('empty shuffle')
+
+            path = self.file_at_rank(self.permute((self.start + index) % self.length))
+
+        if len(self.recent) >= 16:
+            self.recent = {}
+        self.recent[index] = path
+
+        return path
+
+    # saves index as the current track, where the shuffle resumes next time
+    def played(self, index):
+        if self.length > 0:
+            self.library.save_shuffle(self.path, self.seed, (self.start + index) % self.length)
+
+    def file_at_rank(self, rank):
+        i = bisect.bisect_right(self.counts, rank)
+        if i == len(self.counts):
+            return None
+
+        offset = rank
+        if i > 0:
+            offset -= self.counts[i - 1]
+
+        return self.library.file_at(self.directories[i], offset)
+
+    # the network permutes [0, 4 ** halfBits), at most about four times length, so
+    #  walking the cycle until the value falls in [0, length) takes a few steps
+    def permute(self, value):
+        while True:
+            left = value >> self.halfBits
+            right = value & self.halfMask
+
+            for step in range(self.ROUNDS):
+                left, right = right, left ^ (mix64(self.seed ^ (step << 56) ^ right) & self.halfMask)
+
+            value = (left << self.halfBits) | right
+            if value < self.length:
+                return value
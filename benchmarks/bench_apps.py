@@ -0,0 +1,89 @@
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+import vioslib
+
+# number of app instances hosted at once, and inputs each one reads
+APP_COUNT = 500
+READS = 20
+
+# reads input until interrupted, like an app waiting on its user
+class ThreadedApp(vioslib.VIOSApp):
+    def run(self):
+        vioslib.VIOSApp.run(self)
+
+        self.reads = 0
+        while self.interrupted == False:
+            self.read()
+            self.reads += 1
+
+class CoroutineApp(vioslib.AsyncVIOSApp):
+    async def main(self):
+        self.reads = 0
+        while self.interrupted == False:
+            await self.read()
+            self.reads += 1
+
+def bench(label, appClass, count):
+    # apps only read from their mailboxes, so nothing is ever sent to an engine
+    queueHandler = vioslib.QueueHandler(None, None)
+    scheduler = vioslib.AppScheduler(queueHandler)
+
+    threadsBefore = threading.active_count()
+
+    start = time.perf_counter()
+
+    apps = [appClass(queueHandler) for i in range(count)]
+    for app in apps:
+        # room for every input, so none are dropped while an app catches up
+        app.mailboxOptions = { 'maxLength': READS }
+        scheduler.start(app)
+
+    while not all(app.initialized and app.waiting for app in apps):
+        time.sleep(.01)
+
+    started = time.perf_counter() - start
+    threads = threading.active_count() - threadsBefore
+
+    # deliver input to every app in turn, as many users speaking at once would
+    start = time.perf_counter()
+
+    for i in range(READS):
+        for app in apps:
+            queueHandler.wakeup(app.instanceId)
+
+    while sum(app.reads for app in apps) < count * READS:
+        time.sleep(.001)
+
+    delivered = time.perf_counter() - start
+
+    start = time.perf_counter()
+    remaining = scheduler.shutdown()
+    stopped = time.perf_counter() - start
+
+    print('{0:<10} {1} apps: {2:4} threads, started in {3:.3f}s, '
+          '{4:.0f} reads/s, shut down in {5:.3f}s ({6} left)'.format(label,
+                                                                      count,
+                                                                      threads,
+                                                                      started,
+                                                                      count * READS / delivered,
+                                                                      stopped,
+                                                                      len(remaining)))
+
+def main():
+    count = APP_COUNT
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+
+    # per-message logging would dominate the measurement, so only log warnings
+    vioslib.configure_logging(os.environ.get('VIOS_LOG', 'warning'))
+
+    bench('threads', ThreadedApp, count)
+    bench('coroutines', CoroutineApp, count)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+import vioslib
+
+# number of encode/decode round trips per measurement, and measurements of
+#  which the fastest is reported
+ITERATIONS = 100000
+REPEAT = 9
+
+# representative frames: a short completion and a large grammar set
+MESSAGES = [('completion', vioslib.Message('2', 'synthesisDone', '1234', 'synthesis done')),
+            ('grammarSet', vioslib.Message('3', 'grammarSet', '5678',
+                                           ','.join('folder {0}'.format(i) for i in range(500))))]
+
+def measure(function):
+    return min(timeit.repeat(function, number = ITERATIONS, repeat = REPEAT)) / ITERATIONS * 1e6
+
+# encode builds a whole frame, length included, as written to the pipe; decode
+#  reads the payload FrameReader yields
+def bench(label, encode, decode):
+    encodeTime = measure(encode)
+
+    payload = encode()[vioslib.FRAME_HEADER.size:]
+    decodeTime = measure(lambda: decode(payload))
+
+    print('  {0:<8} {1:>6} bytes  encode {2:6.2f}us  decode {3:6.2f}us'.format(label,
+                                                                             len(payload),
+                                                                             encodeTime,
+                                                                             decodeTime))
+
+def main():
+    for name, message in MESSAGES:
+        print(name)
+
+        bench('text',
+              lambda: vioslib.pack_frame(message.to_str().encode('ascii')),
+              lambda payload: vioslib.Message().from_bytes(payload))
+
+        bench('binary',
+              message.to_frame,
+              lambda payload: vioslib.Message().from_bytes(payload))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+import vioslib
+
+# number of completion messages the stand-in engine sends
+MESSAGE_COUNT = 20000
+
+# stands in for the audio engine by writing completion frames as fast as possible
+def engine_writer(sendPipe, instanceId, count):
+    for i in range(count):
+        vioslib.pipe_write(sendPipe, vioslib.Message(instanceId,
+                                                     'synthesisDone',
+                                                     str(i + 1),
+                                                     'synthesis done').to_str())
+    sendPipe.close()
+
+def main():
+    count = MESSAGE_COUNT
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+
+    readFd, writeFd = os.pipe()
+    recvPipe = open(readFd, 'rb', 0)
+    sendPipe = open(writeFd, 'wb', 0)
+
+    queueHandler = vioslib.QueueHandler(recvPipe, None)
+
+    instanceId = queueHandler.get_instance_id()
+    queueHandler.register_instance(instanceId)
+
+    # consume every message in order rather than measuring mailbox eviction
+    queueHandler.instanceMailboxDict[instanceId].maxLength = count
+
+    # frame logging would dominate the measurement, so only log warnings
+    vioslib.configure_logging(os.environ.get('VIOS_LOG', 'warning'))
+
+    start = time.perf_counter()
+
+    queueHandler.daemon = True
+    queueHandler.start()
+
+    writer = threading.Thread(target = engine_writer, args = (sendPipe, instanceId, count))
+    writer.daemon = True
+    writer.start()
+
+    # block on each completion in turn, as an app waiting on a messageId would
+    for i in range(count):
+        queueHandler.read(instanceId, messageId = str(i + 1))
+
+    elapsed = time.perf_counter() - start
+
+    print('Dispatched {0} messages in {1:.3f}s ({2:.0f} messages/s)'.format(count,
+                                                                            elapsed,
+                                                                            count / elapsed))
+
+if __name__ == "__main__":
+    main()
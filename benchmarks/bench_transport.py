@@ -0,0 +1,73 @@
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+import vioslib
+
+# number of request/reply round trips per transport
+ROUND_TRIPS = 5000
+
+# echoes every frame straight back, standing in for the engine's reply path
+def echo_server(transport):
+    recvPipe, sendPipe = transport.open_server()
+
+    for frame in vioslib.FrameReader(recvPipe).frames():
+        vioslib.write_all(sendPipe, vioslib.pack_frame(bytes(frame)))
+
+def bench(label, clientTransport, serverTransport):
+    server = threading.Thread(target = echo_server, args = (serverTransport,))
+    server.daemon = True
+    server.start()
+
+    recvPipe, sendPipe = clientTransport.open()
+    frames = vioslib.FrameReader(recvPipe).frames()
+
+    frame = vioslib.Message('2', 'synthesisDone', '1', 'synthesis done').to_frame()
+
+    latencies = []
+    for i in range(ROUND_TRIPS):
+        start = time.perf_counter()
+
+        vioslib.write_all(sendPipe, frame)
+        next(frames)
+
+        latencies.append(time.perf_counter() - start)
+
+    latencies.sort()
+
+    print('{0:<32} median {1:7.1f}us  p99 {2:7.1f}us'.format(label,
+                                                           statistics.median(latencies) * 1e6,
+                                                           latencies[int(len(latencies) * .99)] * 1e6))
+
+    sendPipe.close()
+    recvPipe.close()
+
+def socket_pair(transportClass, *args, **kwargs):
+    serverTransport = transportClass(*args, **kwargs)
+    serverTransport.listen()
+
+    if transportClass == vioslib.TcpTransport:
+        args = (args[0], serverTransport.port) + args[2:]
+
+    return transportClass(*args, **kwargs), serverTransport
+
+def main():
+    socketPath = os.path.join(tempfile.mkdtemp(), 'vios.sock')
+
+    for options in [{}, { 'buffering': 65536 }, { 'nonblocking': True }]:
+        suffix = ','.join('{0}={1}'.format(k, v) for k, v in options.items())
+
+        bench('pipe ' + suffix, *vioslib.PipeTransport.pair(**options))
+
+        if hasattr(vioslib.socket, 'AF_UNIX'):
+            bench('unix ' + suffix, *socket_pair(vioslib.UnixSocketTransport, socketPath, **options))
+
+        bench('tcp ' + suffix, *socket_pair(vioslib.TcpTransport, '127.0.0.1', 0, **options))
+
+if __name__ == "__main__":
+    main()
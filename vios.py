@@ -1,24 +1,29 @@
-import os
-import queue
-import random
-import sys
-import struct
-import threading
 import time
 
-import imp
-
-vioslib = imp.load_source('vioslib', 'vioslib.py')
+# taken before any imports, so startup time includes them
+startTime = time.time()
 
-audilist = imp.load_source('audilist', 'AudiList\\audilist.py')
-AudiList = audilist.AudiList
+import os
+import sys
 
-audiplay = imp.load_source('audiplay', 'AudiPlay\\audiplay.py')
-AudiPlay = audiplay.AudiPlay
+import vioslib
 
 class VIOSShell(vioslib.VIOSApp):
     def __init__(self, queueHandler):
         vioslib.VIOSApp.__init__(self, queueHandler)
+
+        self.name = 'Shell'
+
+        # fixed prompts, rendered ahead of use if the engine can
+        self.prompts = ['Welcome to VIOS.',
+                        'Choose App, List, or Exit.',
+                        'No active apps.',
+                        'Already in shell.',
+                        'Backgrounding app.',
+                        'Confirm monomorphic mode.',
+                        'Entering monomorphic mode.',
+                        'Returned to polymorphic mode.',
+                        'Goodbye.']
         
         # the shell must track which app is 'foregrounded'
         self.activeApp = None
@@ -32,25 +37,34 @@ class VIOSShell(vioslib.VIOSApp):
 
         vioslib.log_msg('Registered VIOS shell instance as {0}.'.format(self.instanceId))
 
+        # time from process start until the shell can take input
+        startup = time.time() - startTime
+        vioslib.metrics.observe('vios_startup_seconds', startup)
+        vioslib.log_msg('Started up in {0:.0f}ms.'.format(startup * 1000))
+
         self.main()
 
     def main(self):
         self.synthesize('Welcome to VIOS.')
         
-        # create and populate app dictionary
-        apps = {}
-        apps['audilist'] = AudiList(self.queueHandler)
-        apps['audiplay'] = AudiPlay(self.queueHandler)
+        # runs the apps and shuts them down together
+        scheduler = vioslib.AppScheduler(self.queueHandler)
+
+        # find apps in this directory's subdirectories and in installed packages;
+        #  each one is only imported when first chosen
+        registry = vioslib.PluginRegistry()
+        registry.discover(os.path.dirname(os.path.realpath(__file__)))
+        registry.discover_entry_points()
 
         # create shell grammar sets
-        app_choices = ['audilist', 'audiplay']
-        shell_choices = ['active', 'shell', 'monomorphic']
+        app_choices = registry.words()
+        shell_choices = ['active', 'shell', 'monomorphic', 'status']
         shell_exit = ['exit']
 
         def launch_active_app(newApp):
             # launch or foreground app process
             if newApp.initialized == False:
-                newApp.start()
+                scheduler.start(newApp)
             else:
                 newApp.foreground()
 
@@ -62,24 +76,29 @@ class VIOSShell(vioslib.VIOSApp):
             if self.activeApp and self.activeApp.active == False:
                 self.activeApp = None
 
-            # if no active app, do blocking read. Otherwise, non-blocking
+            # if no active app, prompt and read. Otherwise, block until either
+            #  shell input arrives or an app signals a lifecycle change
             choice = ''
             if self.activeApp == None:
                 choice = self.grammar_prompt_and_read(app_choices + shell_choices + shell_exit,
                                                       'Choose App, List, or Exit.')
             else:
-                choice = self.read(block = False)
+                choice = self.read(interruptible = True)
 
-            # if no input (from the non-blocking read), sleep and continue
+            # if woken without input, an app was backgrounded or exited
             if choice == None:
-                time.sleep(.1)
                 continue
 
-            if choice in apps:
+            if choice in app_choices:
                 # set active shell grammar to choices valid from within an app
                 self.set_choices(shell_choices)
 
-                app = apps[choice]
+                try:
+                    app = registry.get(choice, self.queueHandler)
+                except Exception as e:
+                    vioslib.log_msg('Error: failed to load app for {0}: {1}'.format(choice, e), vioslib.ERROR)
+                    self.synthesize('Could not load {0}.'.format(choice))
+                    continue
 
                 # start app on asynchronous thread
                 launch_active_app(app)
@@ -117,6 +136,8 @@ class VIOSShell(vioslib.VIOSApp):
                 # restore app grammar, if any
                 if self.activeApp:
                   self.activeApp.reenable_grammar()
+            elif choice == 'status':
+                self.synthesize(self.status_report(scheduler))
             elif choice == 'list':
                 self.synthesize('List not implemented yet. Need to collapse number sequences somehow.')
             elif choice == 'exit':
@@ -124,45 +145,83 @@ class VIOSShell(vioslib.VIOSApp):
             else:
                 vioslib.log_msg('Error: shell received unrecognized input: {0}'.format(choice))
 
-        # iterate over apps dictionary and close each app
+        # interrupt every app at once, then wait for all of them
         vioslib.log_msg('Closing apps ...')
-        for appName, app in apps.items():
-            if app.initialized:
-                vioslib.log_msg('Interrupting {0} ...'.format(appName))
-                app.interrupted = True
-                vioslib.log_msg('Waking {0} ...'.format(appName))
-                self.queueHandler.wakeup(app.instanceId)
-                vioslib.log_msg('Joining {0} ...'.format(appName))
-                app.join()
+        scheduler.shutdown(closeQueueHandler = False)
 
-        self.synthesize('Goodbye.')
+        # wait for the goodbye to be spoken before the connection closes
+        self.synthesize('Goodbye.').wait(5)
 
         vioslib.log_msg('Exiting.')
 
+    # key figures from vioslib.metrics, phrased for speech
+    def status_report(self, scheduler):
+        metrics = vioslib.metrics
+
+        received = metrics.total('vios_messages_received_total')
+        sent = metrics.total('vios_messages_sent_total')
+
+        dropped = 0
+        for mailbox in list(self.queueHandler.instanceMailboxDict.values()):
+            dropped += mailbox.dropped
+
+        waits, waitTime = metrics.histogram_total('vios_synthesis_wait_seconds')
+        averageWait = 0
+        if waits > 0:
+            averageWait = int(waitTime / waits * 1000)
+
+        grammarUpdates = (metrics.total('vios_grammar_updates_total', { 'kind': 'full' }) +
+                          metrics.total('vios_grammar_updates_total', { 'kind': 'delta' }))
+
+        report = ('{0} messages received, {1} sent, {2} dropped. '
+                  'Average speech queue wait {3} milliseconds. '
+                  '{4} grammar updates.').format(received, sent, dropped, averageWait, grammarUpdates)
+
+        # threaded apps hold a thread each; coroutine apps share the event loop
+        threaded, coroutines = scheduler.counts()
+        report += ' {0} apps on their own threads, {1} on the coroutine loop.'.format(threaded, coroutines)
+
+        promptCache = self.queueHandler.promptCache
+        if promptCache != None and promptCache.hit_rate() != None:
+            report += ' Prompt cache hit rate {0} percent.'.format(int(promptCache.hit_rate() * 100))
+
+        return report
+
 # if running as a script (instead of being a module), call main
 if __name__ == "__main__":
-    start = time.time()
+    # select transport to the audio engine from the command line or environment,
+    #  e.g. 'tcp://127.0.0.1:5555?nodelay=1'. Defaults to the .Net client's named pipes
+    transportSpec = os.environ.get('VIOS_TRANSPORT', 'namedpipe:')
+    if len(sys.argv) > 1:
+        transportSpec = sys.argv[1]
+
+    # set up connections for VIOS input and output
+    recvPipe, sendPipe = vioslib.make_transport(transportSpec).open()
 
-    # set up connection for VIOS input
-    vioslib.log_msg('Connected to named pipe for receiving ...')
-    recvPipe = open(r'\\.\pipe\NPToGE', 'r+b', 0)
-    
-    # set up connection for VIOS output
-    vioslib.log_msg('Connected to named pipe for sending ...')
-    sendPipe = open(r'\\.\pipe\NPFromGE', 'r+b', 0)
+    # optionally export metrics, e.g. 'http://127.0.0.1:9464' or 'file:///tmp/vios.prom'
+    if 'VIOS_METRICS' in os.environ:
+        vioslib.start_metrics(os.environ['VIOS_METRICS'])
 
     # start up QueueHandler that helps proxy between audio engine and apps
     queueHandler = vioslib.QueueHandler(recvPipe, sendPipe)
-    queueHandler.setDaemon(True)
+    queueHandler.daemon = True
     queueHandler.start()
     vioslib.log_msg('Started QueueHandler.')
 
+    # the .Net client only speaks the text protocol over named pipes, so only
+    #  offer binary frames and grammar deltas to other engines
+    if not transportSpec.startswith('namedpipe:'):
+        queueHandler.negotiate()
+
     vioslib.log_msg('Starting shell.')
     VIOSShell(queueHandler).run()
 
+    # make sure final frames (e.g. 'Goodbye.') reach the engine before exiting
+    queueHandler.close(5)
+
     # cleanup
 ## hanging after the first close() for some reason
 ##    recvPipe.close()
 ##    sendPipe.close()
 
-    vioslib.log_msg('Elapsed Time: %s' % int(time.time() - start))
+    vioslib.log_msg('Elapsed Time: %s' % int(time.time() - startTime))
@@ -0,0 +1,633 @@
+import argparse
+import random
+import threading
+import time
+import wave
+
+import vioslib
+
+# Headless stand-in for the .Net audio engine (VIOSDotNetClient). Speaks the same
+#  protocol over any vioslib transport, answers completion requests after
+#  simulated synthesis/playback/recording times, and feeds recognition input
+#  from a script or at random. Durations are divided by speed so whole sessions
+#  can be run faster than real time.
+#
+# Typical local run:
+#  python viosengine.py unix:///tmp/vios.sock --script session.txt --speed 20
+#  python vios.py unix:///tmp/vios.sock
+
+# used for random dictation input when no grammar choices are available
+DICTATION_WORDS = ['alpha', 'bravo', 'charlie', 'delta', 'echo', 'foxtrot']
+
+# message types the engine understands; anything else is logged and ignored
+ENGINE_TYPES = ['break', 'synthesisPause', 'synthesisResume', 'play', 'playAsync',
+                'playerDone', 'synthesisDone', 'recordDone', 'pause', 'unpause',
+                'stop', 'back', 'skip', 'seek', 'volume', 'create', 'delete',
+                'record', 'startDictation', 'speechSynth', 'grammarSet',
+                'grammarAdd', 'grammarRemove', 'clearInstance', 'protocol', 'playNext',
+                'speechRender', 'promptPlay']
+
+# simulated activity (synthesis, playback or recording) with a deadline that can be paused
+class Activity():
+    def __init__(self, _duration, _speed):
+        self.duration = _duration
+        self.speed = _speed
+
+        # wall-clock deadline while running, None while paused
+        self.end = time.time() + _duration / _speed
+
+        # simulated seconds left when paused
+        self.remaining = 0
+
+    def pause(self):
+        if self.end != None:
+            self.remaining = max(0, self.end - time.time()) * self.speed
+            self.end = None
+
+    def resume(self):
+        if self.end == None:
+            self.end = time.time() + self.remaining / self.speed
+
+    def position(self):
+        if self.end == None:
+            return self.duration - self.remaining
+
+        return self.duration - max(0, self.end - time.time()) * self.speed
+
+    # moves playback to a simulated position in seconds
+    def move_to(self, position):
+        position = min(max(0, position), self.duration)
+
+        if self.end == None:
+            self.remaining = self.duration - position
+        else:
+            self.end = time.time() + (self.duration - position) / self.speed
+
+    def finished(self, now):
+        return self.end != None and now >= self.end
+
+class SimulatedEngine():
+    def __init__(self, _transport, script = None, randomInput = False, speed = 1.0,
+                 charTime = .06, synthLatency = .2, playDuration = 5.0, recordDuration = 3.0,
+                 inputDelay = .5, inputTimeout = 30.0, settleTime = .2, seed = None,
+                 features = None):
+        self.transport = _transport
+
+        # protocol features offered to apps, e.g. without playNext to compare
+        #  against an engine that can't preload tracks
+        self.features = features
+        if self.features == None:
+            self.features = vioslib.PROTOCOL_FEATURES
+
+        # recognition input: list of utterances/'wait N' lines, or random choices
+        self.script = script
+        self.randomInput = randomInput
+        self.random = random.Random(seed)
+
+        self.speed = speed
+        self.charTime = charTime
+
+        # seconds a synthesizer takes to start speaking; rendered prompts start at once
+        self.synthLatency = synthLatency
+        self.playDuration = playDuration
+        self.recordDuration = recordDuration
+        self.inputDelay = inputDelay
+        self.inputTimeout = inputTimeout
+
+        # real (unaccelerated) seconds the apps must be silent before scripted input
+        self.settleTime = settleTime
+
+        # protects all engine state and wakes the timer and input threads
+        self.condition = threading.Condition()
+
+        self.synthesis = None
+        self.player = None
+        self.recording = None
+        self.recordStopToken = ''
+
+        # completion requests waiting on each activity
+        self.synthesisWaiters = []
+        self.playerWaiters = []
+        self.recordWaiters = []
+
+        # playNext request for the track to start when the current one ends
+        self.nextTrack = None
+
+        # when the last track ended by itself, for measuring the gap to the next
+        self.trackEndTime = None
+
+        # current grammar; None means no grammar loaded, '' choice set means dictation grammar
+        self.grammar = None
+        self.dictationGrammar = False
+        self.dictationMode = False
+        self.endDictationToken = ''
+        self.dictationResult = ''
+
+        self.binaryFrames = False
+        self.sendPipe = None
+        self.writeLock = threading.Lock()
+
+        self.closed = False
+
+        # time the last command arrived, used to wait for apps to go quiet
+        self.lastReceived = 0
+
+        # measurements reported by summary()
+        self.counts = {}
+        self.grammarWarnings = 0
+        self.rejectedInputs = 0
+        self.inputTimes = []
+        self.responseLatencies = []
+        self.trackGaps = []
+        self.startTime = None
+
+    def run(self):
+        recvPipe, self.sendPipe = self.transport.open_server()
+
+        self.startTime = time.time()
+
+        timerThread = threading.Thread(target = self.process_timers)
+        timerThread.daemon = True
+        timerThread.start()
+
+        inputThread = threading.Thread(target = self.process_input)
+        inputThread.daemon = True
+        inputThread.start()
+
+        for frame in vioslib.FrameReader(recvPipe).frames():
+            self.handle_command(vioslib.Message().from_bytes(frame))
+
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+        vioslib.log_msg('Engine: connection closed.')
+
+    def write_message(self, message):
+        if self.binaryFrames:
+            frame = message.to_frame()
+        else:
+            frame = vioslib.pack_frame(message.to_str().encode('ascii'))
+
+        self.count('sent ' + message.type)
+
+        self.writeLock.acquire()
+        try:
+            vioslib.write_all(self.sendPipe, frame)
+        except (OSError, ValueError):
+            vioslib.log_msg('Engine: could not write {0}.'.format(message.type))
+        finally:
+            self.writeLock.release()
+
+    def reply(self, message, args):
+        message.args = args
+        self.write_message(message)
+
+    def count(self, key):
+        self.counts[key] = self.counts.get(key, 0) + 1
+
+    # mirrors frmMainForm.HandleCommand(). Caller does not hold condition
+    def handle_command(self, message):
+        self.count('received ' + message.type)
+
+        self.lastReceived = time.time()
+
+        if message.type not in ENGINE_TYPES:
+            vioslib.log_msg('Engine: ignoring unknown message type {0}.'.format(message.type))
+            return
+
+        # first synthesis or playback after an input measures app response time,
+        #  up to when its audio starts
+        if message.type in ('speechSynth', 'promptPlay', 'play') and len(self.inputTimes) > 0:
+            latency = time.time() - self.inputTimes.pop(0)
+            if message.type == 'speechSynth':
+                latency += self.synthLatency / self.speed
+
+            self.responseLatencies.append(latency)
+
+        cmdElems = message.args.split(',')
+
+        with self.condition:
+            if message.type == 'break':
+                self.synthesis = None
+            elif message.type == 'synthesisPause':
+                if self.synthesis != None:
+                    self.synthesis.pause()
+            elif message.type == 'synthesisResume':
+                if self.synthesis != None:
+                    self.synthesis.resume()
+            elif message.type == 'play':
+                if self.player != None:
+                    vioslib.log_msg("Engine: can't start audio because audio player is currently in use.")
+                else:
+                    self.cancel_next_track()
+                    self.start_track()
+            elif message.type == 'playNext':
+                # replaces any track already queued; with nothing playing it starts now
+                self.cancel_next_track()
+                if self.player == None:
+                    self.start_track()
+                    self.reply(message, 'track started')
+                else:
+                    self.nextTrack = message
+            elif message.type == 'playerDone':
+                if self.player == None:
+                    self.reply(message, 'player done')
+                else:
+                    self.playerWaiters.append(message)
+            elif message.type == 'synthesisDone':
+                if self.synthesis == None:
+                    self.reply(message, 'synthesis done')
+                else:
+                    self.synthesisWaiters.append(message)
+            elif message.type == 'recordDone':
+                if self.recording == None:
+                    self.reply(message, 'record done')
+                else:
+                    self.recordWaiters.append(message)
+            elif message.type == 'pause':
+                if self.player != None:
+                    self.player.pause()
+            elif message.type == 'unpause':
+                if self.player != None:
+                    self.player.resume()
+            elif message.type == 'stop':
+                self.player = None
+                self.trackEndTime = None
+                self.cancel_next_track()
+            elif message.type in ('back', 'skip', 'seek'):
+                if self.player != None:
+                    try:
+                        value = int(cmdElems[0])
+                    except ValueError:
+                        vioslib.log_msg('Engine: could not parse {0}. Value={1}'.format(message.type, cmdElems[0]))
+                        value = 0
+
+                    if message.type == 'back':
+                        self.player.move_to(self.player.position() - value)
+                    elif message.type == 'skip':
+                        self.player.move_to(self.player.position() + value)
+                    else:
+                        # like the .Net client: forward by percent times the track's
+                        #  length in hundreds of seconds, rounded half to even as
+                        #  Convert.ToInt32 does, so short tracks don't move
+                        self.player.move_to(self.player.position() + value * round(self.player.duration / 100))
+            elif message.type == 'record':
+                if self.recording != None:
+                    vioslib.log_msg('Engine: already recording.')
+                else:
+                    self.recording = Activity(self.recordDuration, self.speed)
+                    self.recordStopToken = cmdElems[1] if len(cmdElems) > 1 else ''
+            elif message.type == 'startDictation':
+                self.dictationGrammar = True
+                self.dictationMode = True
+                self.endDictationToken = cmdElems[0].lower()
+                self.dictationResult = ''
+            elif message.type == 'speechSynth':
+                if self.synthesis != None:
+                    vioslib.log_msg("Engine: ERROR: can't synthesize speech because synthesization is currently in progress.")
+                else:
+                    self.synthesis = Activity(self.synthLatency + len(message.args) * self.charTime, self.speed)
+            elif message.type == 'speechRender':
+                # renders as silence as long as synthesizing the text would take
+                path, text = message.args.split(',', 1)
+                try:
+                    self.write_silence(path, len(text) * self.charTime)
+                    self.reply(message, 'render done')
+                except OSError as e:
+                    vioslib.log_msg('Engine: could not render {0}: {1}'.format(path, e))
+                    self.reply(message, 'render failed')
+            elif message.type == 'promptPlay':
+                # a rendered prompt plays on the synthesis channel, so synthesisDone
+                #  and break treat it like speech
+                if self.synthesis != None:
+                    vioslib.log_msg("Engine: ERROR: can't play prompt because synthesization is currently in progress.")
+                else:
+                    try:
+                        with wave.open(message.args, 'rb') as prompt:
+                            duration = prompt.getnframes() / prompt.getframerate()
+                    except (OSError, wave.Error) as e:
+                        vioslib.log_msg('Engine: could not play prompt {0}: {1}'.format(message.args, e))
+                    else:
+                        self.synthesis = Activity(duration, self.speed)
+            elif message.type == 'grammarSet':
+                self.set_grammar(message.args)
+            elif message.type == 'grammarAdd':
+                self.dictationMode = False
+                self.dictationGrammar = False
+                # dictation leaves no grammar, which a delta applies to as empty
+                self.grammar = (self.grammar or set()) | self.parse_grammar(message.args)
+            elif message.type == 'grammarRemove':
+                self.grammar = (self.grammar or set()) - self.parse_grammar(message.args)
+            elif message.type == 'protocol':
+                # answer in the current format, then switch to binary for later replies
+                accepted = [feature for feature in cmdElems if feature in self.features]
+                self.reply(message, ','.join(accepted))
+
+                if vioslib.BINARY_PROTOCOL in accepted:
+                    self.binaryFrames = True
+
+            # activities may have ended or grammar changed
+            self.condition.notify_all()
+
+    def write_silence(self, path, duration):
+        with wave.open(path, 'wb') as prompt:
+            prompt.setnchannels(1)
+            prompt.setsampwidth(1)
+            prompt.setframerate(8000)
+            prompt.writeframes(b'\x80' * int(duration * 8000))
+
+    # builds the recognizer grammar, reporting choices the .Net client would mangle
+    def set_grammar(self, args):
+        self.dictationMode = False
+
+        # an empty args string indicates use of the dictation dictionary
+        if args == '':
+            self.grammar = set()
+            self.dictationGrammar = True
+            return
+
+        self.dictationGrammar = False
+
+        self.grammar = self.parse_grammar(args)
+
+    def parse_grammar(self, args):
+        grammar = set()
+        for choice in args.split(','):
+            if choice.strip() == '':
+                self.grammar_warning('empty choice in grammar')
+                continue
+
+            if choice != choice.strip():
+                self.grammar_warning('choice has surrounding whitespace: "{0}"'.format(choice))
+
+            if choice.lower() in grammar:
+                self.grammar_warning('duplicate choice: "{0}"'.format(choice))
+
+            grammar.add(choice.lower())
+
+        return grammar
+
+    def grammar_warning(self, warning):
+        self.grammarWarnings += 1
+        vioslib.log_msg('Engine: grammar warning: ' + warning, vioslib.WARNING)
+
+    # completes finished activities and answers their waiters
+    def process_timers(self):
+        with self.condition:
+            while self.closed == False:
+                now = time.time()
+
+                if self.synthesis != None and self.synthesis.finished(now):
+                    self.synthesis = None
+                if self.player != None and self.player.finished(now):
+                    self.player = None
+                    self.trackEndTime = now
+
+                    # a queued track starts without waiting for the app
+                    if self.nextTrack != None:
+                        self.start_track()
+                        self.reply(self.nextTrack, 'track started')
+                        self.nextTrack = None
+                if self.recording != None and self.recording.finished(now):
+                    self.recording = None
+
+                self.answer_waiters()
+
+                deadlines = [activity.end for activity in (self.synthesis, self.player, self.recording)
+                             if activity != None and activity.end != None]
+
+                if len(deadlines) > 0:
+                    self.condition.wait(max(0, min(deadlines) - time.time()))
+                else:
+                    self.condition.wait()
+
+    # caller holds condition
+    def start_track(self):
+        if self.trackEndTime != None:
+            self.trackGaps.append(time.time() - self.trackEndTime)
+            self.trackEndTime = None
+
+        self.player = Activity(self.playDuration, self.speed)
+
+    # caller holds condition
+    def cancel_next_track(self):
+        if self.nextTrack != None:
+            self.reply(self.nextTrack, 'next cancelled')
+            self.nextTrack = None
+
+    # caller holds condition
+    def answer_waiters(self):
+        if self.synthesis == None:
+            for message in self.synthesisWaiters:
+                self.reply(message, 'synthesis done')
+            self.synthesisWaiters = []
+
+        if self.player == None:
+            for message in self.playerWaiters:
+                self.reply(message, 'player done')
+            self.playerWaiters = []
+
+        if self.recording == None:
+            for message in self.recordWaiters:
+                self.reply(message, 'record done')
+            self.recordWaiters = []
+
+    def process_input(self):
+        if self.script != None:
+            for line in self.script:
+                line = line.strip()
+                if line == '' or line.startswith('#'):
+                    continue
+
+                if line.startswith('wait '):
+                    time.sleep(float(line.split()[1]) / self.speed)
+                    continue
+
+                time.sleep(self.inputDelay / self.speed)
+
+                # '!' speaks over any prompt instead of waiting for it to finish
+                if line.startswith('!'):
+                    self.recognize(line[1:].strip().lower(), self.inputTimeout / self.speed, bargeIn = True)
+                else:
+                    self.recognize(line.lower(), self.inputTimeout / self.speed, self.settleTime)
+
+            vioslib.log_msg('Engine: script finished.')
+        elif self.randomInput:
+            while self.closed == False:
+                time.sleep(self.inputDelay / self.speed)
+
+                with self.condition:
+                    if self.dictationGrammar or self.grammar == None or len(self.grammar) == 0:
+                        choices = DICTATION_WORDS
+                    else:
+                        choices = sorted(self.grammar)
+
+                self.recognize(self.random.choice(choices), 0)
+
+    # waits up to timeout for text to become valid and, for scripted input, for
+    #  the apps to go quiet for settle seconds, then delivers it as the recognizer
+    #  would. Input that never matches is dropped like a false match
+    # barge-in input is delivered as soon as it's valid, over any speech
+    def recognize(self, text, timeout, settle = 0, bargeIn = False):
+        deadline = time.time() + timeout
+        with self.condition:
+            while True:
+                if self.closed:
+                    return
+
+                now = time.time()
+                if self.accepts(text) and bargeIn:
+                    break
+
+                if self.accepts(text):
+                    # like a user waiting for the prompt to finish before answering
+                    quietLeft = self.lastReceived + settle - now
+                    if self.synthesis == None and quietLeft <= 0:
+                        break
+
+                    if now < deadline:
+                        self.condition.wait(max(quietLeft, .001) if self.synthesis == None else deadline - now)
+                        continue
+
+                    # give up waiting for quiet, but still speak over the prompt
+                    break
+
+                if now >= deadline:
+                    self.rejectedInputs += 1
+                    vioslib.log_msg('Engine: input not in grammar: ' + text)
+                    return
+
+                self.condition.wait(deadline - now)
+
+            # recording consumes any recognized speech as its stop signal
+            if self.recording != None:
+                self.recording = None
+                self.condition.notify_all()
+                return
+
+            responseType = 'grammarMatch'
+
+            if self.dictationMode:
+                self.dictationResult += ' ' + text
+
+                # just return if dictation not yet complete (no end token received yet)
+                if self.endDictationToken not in self.dictationResult:
+                    return
+
+                text = self.dictationResult.lstrip()
+
+                self.dictationMode = False
+                self.dictationGrammar = False
+                self.grammar = None
+
+                responseType = 'dictationResult'
+            elif self.dictationGrammar:
+                # single-word dictation-grammar mode sends the first word
+                text = text.split()[0]
+
+        self.inputTimes.append(time.time())
+
+        self.write_message(vioslib.Message('1', responseType, '1', text))
+
+    # caller holds condition
+    def accepts(self, text):
+        if self.recording != None:
+            return self.recordStopToken == '' or text == self.recordStopToken
+
+        if self.dictationGrammar:
+            return True
+
+        return self.grammar != None and text in self.grammar
+
+    def summary(self):
+        elapsed = time.time() - self.startTime
+
+        lines = ['Engine summary ({0:.2f}s, speed x{1}):'.format(elapsed, self.speed)]
+
+        received = sum(count for key, count in self.counts.items() if key.startswith('received '))
+        sent = sum(count for key, count in self.counts.items() if key.startswith('sent '))
+        lines.append('  messages received {0} ({1:.0f}/s), sent {2} ({3:.0f}/s)'.format(received,
+                                                                                   received / elapsed,
+                                                                                   sent,
+                                                                                   sent / elapsed))
+
+        for key in sorted(self.counts):
+            lines.append('    {0}: {1}'.format(key, self.counts[key]))
+
+        lines.append('  grammar warnings {0}, rejected inputs {1}'.format(self.grammarWarnings,
+                                                                          self.rejectedInputs))
+
+        synthesized = self.counts.get('received speechSynth', 0)
+        prompted = self.counts.get('received promptPlay', 0)
+        if synthesized + prompted > 0:
+            lines.append('  speech: {0} synthesized, {1} played from rendered prompts ({2:.0f}%)'.format(synthesized,
+                                                                                                    prompted,
+                                                                                                    100 * prompted / (synthesized + prompted)))
+
+        if len(self.responseLatencies) > 0:
+            latencies = sorted(self.responseLatencies)
+            lines.append('  input->response latency: median {0:.1f}ms, max {1:.1f}ms over {2} inputs'.format(latencies[len(latencies) // 2] * 1000,
+                                                                                                            latencies[-1] * 1000,
+                                                                                                            len(latencies)))
+
+        if len(self.trackGaps) > 0:
+            gaps = sorted(self.trackGaps)
+            lines.append('  track end->next track start: median {0:.1f}ms, max {1:.1f}ms over {2} tracks'.format(gaps[len(gaps) // 2] * 1000,
+                                                                                                           gaps[-1] * 1000,
+                                                                                                           len(gaps)))
+
+        return '\n'.join(lines)
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Headless stand-in VIOS audio engine.')
+    parser.add_argument('transport', help = "server end of the transport, e.g. 'unix:///tmp/vios.sock'")
+    parser.add_argument('--script', help = "file of utterances, one per line ('wait N' pauses N seconds, "
+                                           "'!' before an utterance speaks it over any prompt)")
+    parser.add_argument('--random', action = 'store_true', help = 'speak random valid choices')
+    parser.add_argument('--seed', type = int, help = 'random input seed')
+    parser.add_argument('--speed', type = float, default = 1.0, help = 'time acceleration factor')
+    parser.add_argument('--char-time', type = float, default = .06, help = 'synthesis seconds per character')
+    parser.add_argument('--synth-latency', type = float, default = .2,
+                        help = 'seconds before synthesized speech starts')
+    parser.add_argument('--play-duration', type = float, default = 5.0, help = 'seconds per played file')
+    parser.add_argument('--record-duration', type = float, default = 3.0, help = 'maximum recording seconds')
+    parser.add_argument('--input-delay', type = float, default = .5, help = 'seconds before each utterance')
+    parser.add_argument('--settle-time', type = float, default = .2,
+                        help = 'real seconds without app traffic before each scripted utterance')
+    parser.add_argument('--refuse', action = 'append', default = [],
+                        help = "protocol feature not to accept, e.g. 'playNext/1' (repeatable)")
+    args = parser.parse_args()
+
+    script = None
+    if args.script != None:
+        with open(args.script) as scriptFile:
+            script = scriptFile.readlines()
+
+    engine = SimulatedEngine(vioslib.make_transport(args.transport),
+                             script = script,
+                             randomInput = args.random,
+                             speed = args.speed,
+                             charTime = args.char_time,
+                             synthLatency = args.synth_latency,
+                             playDuration = args.play_duration,
+                             recordDuration = args.record_duration,
+                             inputDelay = args.input_delay,
+                             settleTime = args.settle_time,
+                             seed = args.seed,
+                             features = [feature for feature in vioslib.PROTOCOL_FEATURES
+                                         if feature not in args.refuse])
+
+    vioslib.log_msg('Engine: waiting for connection on {0} ...'.format(args.transport))
+    try:
+        engine.run()
+    except KeyboardInterrupt:
+        pass
+
+    # keep the summary after the engine's queued log lines
+    vioslib.flush_log(1)
+
+    print(engine.summary())
+
+if __name__ == "__main__":
+    main()
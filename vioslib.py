@@ -1,15 +1,480 @@
+import asyncio
+import atexit
+import bisect
 import collections
+import concurrent.futures
 import datetime
+import hashlib
+import http.server
+import importlib.metadata
+import importlib.util
+import json
 import os
+import queue
 import random
+import selectors
+import socket
 import sys
 import struct
 import threading
 import time
+import urllib.parse
+
+# log levels, numbered as in the standard logging module
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+LOG_LEVELS = { 'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'error': ERROR, 'off': 100 }
+
+# formats and writes log records on a background thread so console I/O stays off
+#  the message path; callers only append a record to a deque
+# frames go to the 'frames' module and are also kept in a ring buffer of recent
+#  frames for post-mortems, whether or not they are printed
+class LogSink(threading.Thread):
+    def __init__(self, maxRecords = 10000, ringLength = 200):
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        # None writes to whatever sys.stdout is at the time
+        self.stream = None
+
+        self.condition = threading.Condition()
+        self.records = collections.deque()
+        self.writing = False
+
+        # records beyond maxRecords are dropped and counted rather than blocking
+        self.maxRecords = maxRecords
+        self.dropped = 0
+
+        # default threshold and per-module overrides
+        self.level = INFO
+        self.moduleLevels = {}
+
+        # print one of every frameSample frames, and none while the backlog
+        #  exceeds frameBacklog records
+        self.frameSample = 1
+        self.frameBacklog = maxRecords // 2
+        self.frameCount = 0
+        self.framesSkipped = 0
+
+        self.recentFrames = collections.deque(maxlen = ringLength)
+
+    def enabled(self, level, module = None):
+        return level >= self.moduleLevels.get(module, self.level)
+
+    # parses specs like 'info,frames=off,queue=debug,sample=10'
+    def configure(self, spec):
+        for setting in spec.split(','):
+            setting = setting.strip().lower()
+            if setting == '':
+                continue
+
+            if '=' not in setting:
+                self.level = LOG_LEVELS[setting]
+                continue
+
+            key, value = setting.split('=', 1)
+            if key == 'sample':
+                self.frameSample = max(1, int(value))
+            elif key == 'ring':
+                self.recentFrames = collections.deque(self.recentFrames, maxlen = int(value))
+            else:
+                self.moduleLevels[key] = LOG_LEVELS[value]
+
+    def log(self, level, module, msg):
+        if level < self.moduleLevels.get(module, self.level):
+            return
+
+        with self.condition:
+            if len(self.records) >= self.maxRecords:
+                self.dropped += 1
+                return
+
+            self.records.append((time.time(), level, msg))
+
+            if self.ident == None:
+                self.start()
+
+            self.condition.notify_all()
+
+    # direction is '<' for frames read from the engine and '>' for frames sent
+    # message may be a Message or an already serialized string, and is only
+    #  formatted by the sink thread
+    def frame(self, direction, message):
+        self.recentFrames.append((time.time(), direction, message))
+
+        if INFO < self.moduleLevels.get('frames', self.level):
+            return
+
+        self.frameCount += 1
+        if self.frameCount % self.frameSample != 0 or len(self.records) >= self.frameBacklog:
+            self.framesSkipped += 1
+            return
+
+        self.log(INFO, 'frames', (direction, message))
+
+    def format(self, timestamp, level, msg):
+        if isinstance(msg, tuple):
+            msg = format_frame(*msg)
+
+        dtstr = str(datetime.datetime.fromtimestamp(timestamp)).split('.')[0]
+
+        if level >= WARNING:
+            return '{0}: {1}: {2}'.format(dtstr, LEVEL_NAMES[level], msg)
+
+        return '{0}: {1}'.format(dtstr, msg)
+
+    def run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: len(self.records) > 0)
+
+                batch = list(self.records)
+                self.records.clear()
+                self.writing = True
+
+                dropped = self.dropped
+                self.dropped = 0
+
+            lines = [self.format(*record) for record in batch]
+            if dropped > 0:
+                lines.append(self.format(time.time(), WARNING, 'log backlog full, dropped {0} records'.format(dropped)))
+
+            stream = self.stream
+            if stream == None:
+                stream = sys.stdout
+
+            try:
+                stream.write('\n'.join(lines) + '\n')
+                stream.flush()
+            except (OSError, ValueError):
+                pass
+
+            with self.condition:
+                self.writing = False
+                self.condition.notify_all()
+
+    # blocks until every queued record has been written, or timeout expires
+    def flush(self, timeout = None):
+        with self.condition:
+            if self.ident == None:
+                return True
+
+            return self.condition.wait_for(lambda: len(self.records) == 0 and self.writing == False,
+                                           timeout)
+
+    # formatted copies of the frames in the ring buffer, oldest first
+    def recent_frames(self):
+        frames = []
+        for timestamp, direction, message in list(self.recentFrames):
+            dtstr = str(datetime.datetime.fromtimestamp(timestamp))
+            frames.append('{0}: {1}'.format(dtstr, format_frame(direction, message)))
+
+        return frames
+
+LEVEL_NAMES = dict((level, name.upper()) for name, level in LOG_LEVELS.items())
+
+def format_frame(direction, message):
+    if isinstance(message, Message):
+        message = message.to_str()
+
+    if direction == '<':
+        return 'Read message: ' + message
+
+    return 'Sending message: ' + message
+
+logSink = LogSink()
+logSink.configure(os.environ.get('VIOS_LOG', ''))
+
+# write out whatever is still queued when the interpreter exits
+atexit.register(logSink.flush, 1)
+
+def log_msg(msg, level = INFO, module = None):
+    logSink.log(level, module, msg)
+
+def log_frame(direction, message):
+    logSink.frame(direction, message)
+
+# e.g. configure_logging('warning,frames=info,sample=10'); also read from $VIOS_LOG
+def configure_logging(spec):
+    logSink.configure(spec)
+
+def flush_log(timeout = None):
+    return logSink.flush(timeout)
+
+# logs the ring buffer of recent frames, e.g. after the engine misbehaves
+def log_recent_frames(reason):
+    log_msg('{0}. Recent frames:\n{1}'.format(reason, '\n'.join(logSink.recent_frames())), ERROR)
+
+# upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = [.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30]
+
+class Histogram():
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+# counters and latency histograms labelled by message type, instance or app,
+#  rendered in the Prometheus text format
+# values that already live elsewhere, like mailbox depths, are read by
+#  collectors when a snapshot is taken rather than updated on every message
+class Metrics():
+    def __init__(self):
+        self.lock = threading.Lock()
+
+        # name -> { labels tuple: value or Histogram }
+        self.counters = {}
+        self.histograms = {}
+
+        # name -> help text
+        self.descriptions = {}
+
+        # functions returning (name, kind, labels dict, value) samples
+        self.collectors = []
+
+    def describe(self, name, description):
+        self.descriptions[name] = description
+
+    def inc(self, name, labels = None, amount = 1):
+        key = label_key(labels)
+
+        with self.lock:
+            series = self.counters.get(name)
+            if series == None:
+                series = self.counters[name] = {}
+            series[key] = series.get(key, 0) + amount
+
+    def observe(self, name, value, labels = None):
+        key = label_key(labels)
+
+        self.lock.acquire()
+        series = self.histograms.setdefault(name, {})
+        histogram = series.get(key)
+        if histogram == None:
+            histogram = series[key] = Histogram(LATENCY_BUCKETS)
+        histogram.observe(value)
+        self.lock.release()
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    # sum of a counter over all label sets matching labels
+    def total(self, name, labels = None):
+        labels = labels or {}
+
+        self.lock.acquire()
+        try:
+            total = 0
+            for key, value in self.counters.get(name, {}).items():
+                if all(pair in key for pair in labels.items()):
+                    total += value
+            return total
+        finally:
+            self.lock.release()
+
+    # (count, sum) of a histogram over all label sets matching labels
+    def histogram_total(self, name, labels = None):
+        labels = labels or {}
+
+        self.lock.acquire()
+        try:
+            count = 0
+            total = 0
+            for key, histogram in self.histograms.get(name, {}).items():
+                if all(pair in key for pair in labels.items()):
+                    count += histogram.count
+                    total += histogram.sum
+            return count, total
+        finally:
+            self.lock.release()
+
+    def render(self):
+        gauges = {}
+        for collector in list(self.collectors):
+            for name, kind, labels, value in collector():
+                gauges.setdefault((name, kind), []).append((label_key(labels), value))
+
+        lines = []
+
+        self.lock.acquire()
+        try:
+            for name in sorted(self.counters):
+                self.render_header(lines, name, 'counter')
+                for key, value in sorted(self.counters[name].items()):
+                    lines.append('{0}{1} {2}'.format(name, format_labels(key), value))
+
+            for name in sorted(self.histograms):
+                self.render_header(lines, name, 'histogram')
+                for key, histogram in sorted(self.histograms[name].items()):
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets + ['+Inf'], histogram.counts):
+                        cumulative += count
+                        lines.append('{0}_bucket{1} {2}'.format(name,
+                                                                format_labels(key + (('le', str(bound)),)),
+                                                                cumulative))
+                    lines.append('{0}_sum{1} {2}'.format(name, format_labels(key), histogram.sum))
+                    lines.append('{0}_count{1} {2}'.format(name, format_labels(key), histogram.count))
+        finally:
+            self.lock.release()
+
+        for (name, kind), samples in sorted(gauges.items()):
+            self.render_header(lines, name, kind)
+            for key, value in sorted(samples):
+                lines.append('{0}{1} {2}'.format(name, format_labels(key), value))
+
+        return '\n'.join(lines) + '\n'
+
+    def render_header(self, lines, name, kind):
+        if name in self.descriptions:
+            lines.append('# HELP {0} {1}'.format(name, self.descriptions[name]))
+        lines.append('# TYPE {0} {1}'.format(name, kind))
+
+    # replaces path atomically so scrapers never read a partial file
+    def write_file(self, path):
+        tempPath = path + '.tmp'
+        with open(tempPath, 'w') as metricsFile:
+            metricsFile.write(self.render())
+        os.replace(tempPath, path)
+
+def label_key(labels):
+    if not labels:
+        return ()
+
+    # most series have a single label, which needs no sorting
+    if len(labels) == 1:
+        for name, value in labels.items():
+            return ((name, str(value)),)
+
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+def format_labels(key):
+    if len(key) == 0:
+        return ''
+
+    return '{' + ','.join('{0}="{1}"'.format(name, value.replace('\\', '\\\\').replace('"', '\\"'))
+                          for name, value in key) + '}'
+
+metrics = Metrics()
+metrics.describe('vios_messages_received_total', 'Messages read from the engine.')
+metrics.describe('vios_messages_sent_total', 'Messages queued for the engine.')
+metrics.describe('vios_messages_delivered_total', 'Messages placed in an instance mailbox.')
+metrics.describe('vios_messages_undeliverable_total', 'Messages no instance could receive.')
+metrics.describe('vios_command_latency_seconds', 'Time from writing a command to its reply.')
+metrics.describe('vios_synthesis_wait_seconds', 'Time an utterance waits in its SpeechQueue before it is sent to the synthesizer.')
+metrics.describe('vios_grammar_set_seconds', 'Time GrammarMapper takes to apply an instance grammar.')
+metrics.describe('vios_grammar_updates_total', 'Grammar updates requested, by how they were sent.')
+metrics.describe('vios_write_batch_frames', 'Frames coalesced into each write.')
+metrics.describe('vios_directory_cache_total', 'Directory listings served from cache or rescanned.')
+metrics.describe('vios_track_gap_seconds', 'Time from playerDone to sending the next track.')
+metrics.describe('vios_apps', 'Running apps, by kind (own thread or coroutine loop) and whether they are waiting for input.')
+
+# writes metrics to a text file every interval seconds, for e.g. the node
+#  exporter's textfile collector
+class MetricsFileWriter(threading.Thread):
+    def __init__(self, path, interval = 5):
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        self.path = path
+        self.interval = interval
+
+    def run(self):
+        while True:
+            try:
+                metrics.write_file(self.path)
+            except OSError as e:
+                log_msg('MetricsFileWriter: could not write {0}: {1}'.format(self.path, e), WARNING)
+
+            time.sleep(self.interval)
+
+class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = metrics.render().encode('utf-8')
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # requests are not worth a log line each
+    def log_message(self, format, *args):
+        pass
+
+# exports metrics as described by spec:
+#  'file:///path/vios.prom?interval=5' rewrites a text file periodically
+#  'http://127.0.0.1:9464' serves the current snapshot on every request
+def start_metrics(spec):
+    url = urllib.parse.urlsplit(spec)
+    options = dict(urllib.parse.parse_qsl(url.query))
+
+    if url.scheme == 'file':
+        exporter = MetricsFileWriter(url.path, float(options.get('interval', 5)))
+        exporter.start()
+    elif url.scheme == 'http':
+        server = http.server.ThreadingHTTPServer((url.hostname or '127.0.0.1', url.port or 9464),
+                                                 MetricsRequestHandler)
+        server.daemon_threads = True
+
+        exporter = threading.Thread(target = server.serve_forever)
+        exporter.daemon = True
+        exporter.start()
+    else:
+        raise ValueError('unknown metrics exporter: ' + spec)
+
+    log_msg('Exporting metrics to {0}.'.format(spec))
+
+    return exporter
+
+# entries per page of a spoken listing
+LISTING_PAGE_SIZE = 10
+
+# voice commands for moving around a spoken listing of pageCount pages
+def listing_commands(pageCount):
+    commands = ['repeat page']
+    if pageCount > 1:
+        commands += ['next page', 'previous page'] + ['page {0}'.format(page + 1) for page in range(pageCount)]
+
+    return commands
+
+# text of one page of a listing, built only when the page is about to be spoken
+def listing_page(entries, page, pageSize, numbered):
+    pageCount = (len(entries) + pageSize - 1) // pageSize
+
+    parts = []
+    for i in range(page * pageSize, min((page + 1) * pageSize, len(entries))):
+        if numbered:
+            parts.append('{0} - {1}'.format(i + 1, entries[i]))
+        else:
+            parts.append(entries[i])
+
+    text = ', '.join(parts) + '.'
+    if pageCount > 1:
+        text = 'Page {0} of {1}. '.format(page + 1, pageCount) + text
+
+    return text
 
-def log_msg(msg):
-    dtstr = str(datetime.datetime.now()).split('.')[0]
-    print('{0}: {1}'.format(dtstr, msg))
+# page a listing command moves to from page, or None if it isn't one
+def listing_target(command, page, pageCount):
+    if command == 'repeat page':
+        return page
+    elif command == 'next page':
+        return min(page + 1, pageCount - 1)
+    elif command == 'previous page':
+        return max(page - 1, 0)
+    elif command.startswith('page ') and command[5:].isdigit():
+        return min(max(int(command[5:]) - 1, 0), pageCount - 1)
+
+    return None
 
 class VIOSApp(threading.Thread):
     def __init__(self, _queueHandler):
@@ -41,9 +506,25 @@ class VIOSApp(threading.Thread):
         # used to re-prompt when app is foregrounded
         self.lastSynthesis = ''
 
+        # SpeechQueue for synthesize(), created once the app is registered
+        self.speechQueue = None
+
+        # set while the app is blocked waiting for input or a completion; only
+        #  reported, it doesn't free a threaded app's thread
+        self.waiting = False
+
+        # AppScheduler hosting the app, if any
+        self.scheduler = None
+
         # used to protect changes to the app's current grammar
         self.grammarLock = threading.Lock()
 
+        # Mailbox() keyword arguments for this app's mailbox, e.g. capacity and policy
+        self.mailboxOptions = {}
+
+        # fixed texts the app synthesizes, rendered ahead of use if the engine can
+        self.prompts = []
+
     def cleanup(self):
         self.initialized = False
         self.active = False
@@ -58,6 +539,9 @@ class VIOSApp(threading.Thread):
         # causes grammar-matching to be reset for this instance
         self.queueHandler.grammarMapper.set_grammar(self.instanceId, []) 
 
+        # let the shell know this app is no longer active
+        self.queueHandler.notify_lifecycle()
+
 # TODO: need to do something about QueueHandler registration here?
 
     def run(self):
@@ -65,7 +549,12 @@ class VIOSApp(threading.Thread):
         self.instanceId = self.queueHandler.get_instance_id()
 
         # register instance with QueueHandler
-        self.queueHandler.register_instance(self.instanceId)
+        self.queueHandler.register_instance(self.instanceId, self.mailboxOptions)
+
+        self.speechQueue = SpeechQueue(self.queueHandler,
+                                       self.instanceId,
+                                       self.queueHandler.instanceMailboxDict[self.instanceId],
+                                       self.name)
 
         # this also happens in foreground(), would be nice to reduce to 1 place
         self.queueHandler.grammarMapper.activeApp = self
@@ -76,10 +565,16 @@ class VIOSApp(threading.Thread):
         self.choices = []
         self.lastSynthesis = ''
 
+        if self.queueHandler.promptCache != None:
+            self.queueHandler.promptCache.prewarm(self.prompts)
+
     def background(self):
         self.queueHandler.grammarMapper.activeApp = None
         self.active = False
 
+        # let the shell know this app is no longer active
+        self.queueHandler.notify_lifecycle()
+
     def foreground(self):
         self.active = True
         self.queueHandler.grammarMapper.activeApp = self
@@ -99,62 +594,84 @@ class VIOSApp(threading.Thread):
         self.set_choices([])
             
     def reenable_grammar(self):
-        # causes grammar-matching to be re-enabled for this instance
-        self.set_choices(self.disabledChoices)
-        
+        disabledChoices = self.disabledChoices
+
         self.disabledChoices = []
         self.disabledGrammar = False
+
+        # causes grammar-matching to be re-enabled for this instance
+        self.set_choices(disabledChoices)
             
-    def synthesize(self, text):
+    # queues text for synthesis and returns its SpeechHandle without waiting
+    #  for the synthesizer. With merge False, text is spoken on its own rather
+    #  than joined with utterances queued around it
+    def synthesize(self, text, merge = True):
         if self.initialized == False:
             return
 
         # remember text in case it must be re-synthesized when app is foregrounded
         self.lastSynthesis = text
 
-        # if app is backgrounded, don't actually synthesize anything
+        # a backgrounded app isn't heard, so its output is only remembered, newest
+        #  replacing older, and spoken by foreground()
         if self.active == False:
-            # limit a backgrounded app's synthesizes to one per second
-            time.sleep(1)
-            return
-        
-        # start by requesting notification of synthesization availability
-        command = self.send_command('synthesisDone')
+            return self.speechQueue.defer(text)
 
-        # block for confirmation of availability
-        self.read(messageId = command.messageId)
+        return self.speechQueue.submit(text, merge)
 
-        # send synthesis command
-        self.queueHandler.write(Message(self.instanceId,
-                                        'speechSynth',
-                                        self.queueHandler.get_message_id(),
-                                        text))
+    # stops this app's speech, including anything still queued
+    def break_speech(self):
+        self.speechQueue.flush()
+        self.send_command('break')
 
-    def trigger_grammar_update(self):
-        # sort of a hacky way of not executing if shell hasn't initialized yet
-        if '1' not in self.queueHandler.instanceRecvDequeDict:
-            return
-       
-        # get grammar choices through GrammarMapper
-        choices = self.queueHandler.grammarMapper.get_grammar()
+    # speaks entries a page at a time while listening for choices and for
+    #  listing_commands(), which move between pages
+    # the page after the one being spoken is queued behind it, and nothing
+    #  further is built until it starts. Returns the first of choices heard,
+    #  which stops the listing, or None once the last page has been spoken
+    def speak_listing(self, entries, choices, pageSize = LISTING_PAGE_SIZE, numbered = False):
+        if self.initialized == False:
+            return None
 
-        setMsg = Message()
-        setMsg.instanceId = self.instanceId
-        setMsg.type = 'grammarSet'
-        setMsg.messageId = self.queueHandler.get_message_id()
+        pageCount = max(1, (len(entries) + pageSize - 1) // pageSize)
+        self.set_choices(list(choices) + listing_commands(pageCount))
 
-        # build grammar choices into comma-delimited string
-        choice_str = ''
-        for i in range(len(choices)):
-            choice_str += choices[i] + ','
-        choice_str = choice_str.rstrip(',')
+        page = 0
+        spoken = self.synthesize(listing_page(entries, page, pageSize, numbered), merge = False)
+        while self.interrupted == False:
+            following = None
+            if page + 1 < pageCount:
+                following = self.synthesize(listing_page(entries, page + 1, pageSize, numbered), merge = False)
+
+            result = self.wait_any([spoken])
+
+            if result == 'synthesis done':
+                if following == None:
+                    return None
+
+                page += 1
+                spoken = following
+            elif result in ('speech cancelled', 'speech deferred') or result == None:
+                return None
+            else:
+                self.break_speech()
 
-        setMsg.args = choice_str
+                target = listing_target(result, page, pageCount)
+                if target == None:
+                    return result
 
-        # send grammar set
-        self.queueHandler.write(setMsg)
+                page = target
+                spoken = self.synthesize(listing_page(entries, page, pageSize, numbered), merge = False)
 
-        return setMsg
+        return None
+
+    def trigger_grammar_update(self):
+        # sort of a hacky way of not executing if shell hasn't initialized yet
+        if '1' not in self.queueHandler.instanceMailboxDict:
+            return
+
+        # GrammarSync coalesces bursts and skips grammars the engine already has
+        self.queueHandler.grammarSync.request_update(self.instanceId)
     
     def set_choices(self, newChoices):
         self.grammarLock.acquire()
@@ -179,7 +696,9 @@ class VIOSApp(threading.Thread):
         #  with a unique MessageId each time set_choices() is called.
         return Message('', '', self.queueHandler.get_message_id(), '')
             
-    def send_command(self, type, args = '', messageId = None):
+    # if future is set, returns a Completion that resolves when the engine replies
+    #  to this command. Otherwise returns the sent command
+    def send_command(self, type, args = '', messageId = None, future = False):
         if self.initialized == False:
             return
         
@@ -194,16 +713,51 @@ class VIOSApp(threading.Thread):
 
         command.args = args
 
+        completion = None
+        if future:
+            completion = self.queueHandler.register_completion(command)
+
         # send command
         self.queueHandler.write(command)
 
+        if future:
+            return completion
+
         return command
 
-    def read(self, messageId = None, block = True):
+    # blocks until any of completions resolves or, if grammar is set, a grammar
+    #  match arrives. Returns the args of whichever came first
+    def wait_any(self, completions, grammar = True, interruptible = False):
+        if self.initialized == False:
+            return None
+
+        mailbox = self.queueHandler.instanceMailboxDict[self.instanceId]
+
+        self.waiting = True
+        try:
+            result = mailbox.wait_any(completions, grammar, interruptible)
+        finally:
+            self.waiting = False
+
+        if isinstance(result, Completion):
+            return result.message.args
+        elif result != None:
+            return result.args
+
+        return None
+
+    def read(self, messageId = None, block = True, interruptible = False):
         if self.initialized == False:
             return None
         
-        result = self.queueHandler.read(self.instanceId, messageId = messageId, block = block)
+        self.waiting = True
+        try:
+            result = self.queueHandler.read(self.instanceId,
+                                            messageId = messageId,
+                                            block = block,
+                                            interruptible = interruptible)
+        finally:
+            self.waiting = False
 
         if result != None:
             return result.args
@@ -235,7 +789,7 @@ class VIOSApp(threading.Thread):
         result = self.read()
 
         if prompt != '':
-            self.send_command('break')
+            self.break_speech()
 
         log_msg('grammar_prompt_and_read(): ' + result)
         
@@ -248,90 +802,300 @@ class VIOSApp(threading.Thread):
         if prompt != '':
             self.synthesize(prompt)
 
-        self.send_command('startDictation,' + endDictationToken)
+        self.send_command('startDictation', endDictationToken)
 
         # get dictation result
         result = self.read()
 
+        # the engine drops its grammar when dictation ends, so send it again in full
+        self.queueHandler.grammarSync.reset()
+        self.queueHandler.grammarSync.request_update(self.instanceId)
+
         log_msg('start_dictation(): ' + result)
 
         return result
 
+# immutable view of the grammar currently sent to the recognizer
+# GrammarMapper swaps in a new one whenever the shell's or active app's grammar
+#  changes, so readers never need a lock
+class GrammarSnapshot():
+    def __init__(self, _choices, _activeAppId, _dictation):
+        # merged, de-duplicated shell and active app choices
+        self.choices = _choices
+
+        self.activeAppId = _activeAppId
+
+        # True when the active app wants dictation-style input
+        self.dictation = _dictation
+
 # used to build list of currently valid grammar choices to send to the recognizer
 # also can map a match back to the app it belongs to
 class GrammarMapper():
     def __init__(self):
+        # instance id -> tuple of that instance's choices
         self.instanceDict = {}
 
+        # phrase -> set of instance ids whose grammar contains it, updated
+        #  incrementally by set_grammar()
+        self.phraseDict = {}
+
+        # serializes writers; readers use the current snapshot without locking
         self.instanceLock = threading.Lock()
 
-        self.activeApp = None
+        self.currentActiveApp = None
+
+        self.snapshot = GrammarSnapshot((), None, False)
+
+    @property
+    def activeApp(self):
+        return self.currentActiveApp
+
+    @activeApp.setter
+    def activeApp(self, app):
+        self.instanceLock.acquire()
+        try:
+            self.currentActiveApp = app
+            self.rebuild_snapshot()
+        finally:
+            self.instanceLock.release()
 
     def register_instance(self, instanceId):
-        self.instanceDict[instanceId] = []
+        self.set_grammar(instanceId, [])
 
     def set_grammar(self, instanceId, choices):
-        self.instanceDict[instanceId] = choices
+        newChoices = tuple(choices)
 
-    # returns list of current grammar choices from across all apps
-    def get_grammar(self):
+        startTime = time.time()
+
+        self.instanceLock.acquire()
+        try:
+            oldChoices = self.instanceDict.get(instanceId)
+            if oldChoices == newChoices:
+                return
+
+            if oldChoices == None:
+                oldChoices = ()
+
+            self.instanceDict[instanceId] = newChoices
+
+            # only touch index entries for phrases that were added or removed
+            oldSet = set(oldChoices)
+            newSet = set(newChoices)
+
+            for phrase in oldSet - newSet:
+                instanceIds = self.phraseDict[phrase]
+                instanceIds.discard(instanceId)
+                if len(instanceIds) == 0:
+                    del self.phraseDict[phrase]
+
+            for phrase in newSet - oldSet:
+                self.phraseDict.setdefault(phrase, set()).add(instanceId)
+
+            # backgrounded apps don't affect what the recognizer hears
+            activeApp = self.currentActiveApp
+            if instanceId == '1' or (activeApp is not None and instanceId == activeApp.instanceId):
+                self.rebuild_snapshot()
+        finally:
+            self.instanceLock.release()
+
+            metrics.observe('vios_grammar_set_seconds', time.time() - startTime)
+
+    # builds and swaps in a new snapshot. Caller holds instanceLock
+    def rebuild_snapshot(self):
         # start with shell grammar
-        choices = list(self.instanceDict['1'])
+        choices = self.instanceDict.get('1', ())
 
         # extend with active app's grammar
+        activeApp = self.currentActiveApp
+        activeAppId = None
         activeAppChoices = None
-        if self.activeApp is not None:
-            activeAppChoices = list(self.instanceDict[self.activeApp.instanceId])
+        if activeApp is not None:
+            activeAppId = activeApp.instanceId
+            activeAppChoices = self.instanceDict.get(activeAppId, ())
 
-        # return [] to represent dictation active in app or shell
-        if activeAppChoices == [] and self.activeApp.disabledGrammar == False:
-            return []
-        elif activeAppChoices == None and choices == []:
-            return []
+        # () represents dictation active in app or shell
+        if activeAppChoices == () and activeApp.disabledGrammar == False:
+            self.snapshot = GrammarSnapshot((), activeAppId, True)
+            return
+        elif activeAppChoices == None and choices == ():
+            self.snapshot = GrammarSnapshot((), activeAppId, False)
+            return
 
-        # merge active app and shell grammars
+        # merge active app and shell grammars, weeding out duplicates
         if activeAppChoices is not None:
-            choices += activeAppChoices
+            choices = tuple(dict.fromkeys(choices + activeAppChoices))
 
-        # weed out duplicates between active app and shell
-        temp_dict = {}
-        new_list = []
-        for choice in choices:
-            if choice not in temp_dict:
-                temp_dict[choice] = choice
-                new_list.append(choice)
+        self.snapshot = GrammarSnapshot(choices, activeAppId, False)
 
-        return new_list
+    # returns tuple of current grammar choices from across all apps
+    def get_grammar(self):
+        return self.snapshot.choices
 
     # returns the instance id of the app a grammar match belongs to
+    # only the shell and the active app can match, since only their grammars
+    #  are loaded in the recognizer; the shell wins a phrase both define
     def get_instance(self, match):
-##        if self.activeAppId is not None:
-##            appGrammarList = self.instanceDict[self.activeAppId]
-##            if appGrammarList == [] or match in self.instanceDict[self.activeAppId]:
-##                return self.activeAppId
-##        else:
-##            # this is slightly weird since if there is no active app, the only grammar
-##            #  matches that should occur would be the shell. In fact, isn't get_instance()
-##            #  really only deciding between the active_app and the shell? Couldn't this
-##            #  entire function conceivably be reduced to an if-statement? Possibly it
-##            #  will eventually work differently and multiple apps can be receiving input,
-##            #  but for now it seems simpler.
-        for key1, value1 in self.instanceDict.items():
-            if match in value1:
-                return key1
+        snapshot = self.snapshot
+
+        instanceIds = self.phraseDict.get(match, ())
+        if '1' in instanceIds:
+            return '1'
+        elif snapshot.activeAppId in instanceIds:
+            return snapshot.activeAppId
+
+        # single-word dictation input belongs to the active app
+        if snapshot.dictation:
+            return snapshot.activeAppId
 
         return None
 
     # returns contents of GrammarMapper as a string
     def dump(self):
-        dump_str = 'activeAppId={0}\n'.format(self.activeApp.instanceId)
-        for key1, value1 in self.instanceDict.items():
+        activeAppId = self.snapshot.activeAppId
+
+        dump_str = 'activeAppId={0}\n'.format(activeAppId)
+        for key1, value1 in list(self.instanceDict.items()):
             dump_str += '\tappId={0}\n'.format(key1)
             for value2 in value1:
                 dump_str += '\t\t{0}\n'.format(value2)
 
         return dump_str
 
+# keeps the engine's grammar in step with GrammarMapper's snapshot
+# requests arriving within window seconds of the last update are merged into
+#  one trailing update, identical grammars are never resent, and if the engine
+#  negotiated grammar deltas only added and removed phrases are sent
+# the engine applies grammar messages in order, so the last grammar written is
+#  the one it holds; the .Net client doesn't acknowledge grammarSet otherwise
+class GrammarSync():
+    def __init__(self, _queueHandler, window = .02):
+        self.queueHandler = _queueHandler
+        self.window = window
+
+        self.lock = threading.Lock()
+
+        # grammar tuple last sent to the engine, None until the first update
+        self.lastSent = None
+        self.lastSentTime = 0
+
+        # trailing update timer, set while a merged update is pending
+        self.timer = None
+
+        # instance whose request is carried by the pending update
+        self.pendingInstanceId = None
+
+    def request_update(self, instanceId):
+        self.lock.acquire()
+        try:
+            metrics.inc('vios_grammar_updates_total', { 'kind': 'requested' })
+            self.pendingInstanceId = instanceId
+
+            # an update is already scheduled, it will pick up this change too
+            if self.timer != None:
+                return
+
+            # leading edge: nothing sent recently, so send right away
+            delay = self.lastSentTime + self.window - time.time()
+            if delay <= 0:
+                self.send_update()
+                return
+
+            self.timer = threading.Timer(delay, self.flush)
+            self.timer.daemon = True
+            self.timer.start()
+        finally:
+            self.lock.release()
+
+    def flush(self):
+        self.lock.acquire()
+        try:
+            self.timer = None
+            self.send_update()
+        finally:
+            self.lock.release()
+
+    # caller holds lock
+    def send_update(self):
+        choices = self.queueHandler.grammarMapper.get_grammar()
+
+        if choices == self.lastSent:
+            metrics.inc('vios_grammar_updates_total', { 'kind': 'unchanged' })
+            return
+
+        # empty grammar means dictation, which only a full grammarSet expresses
+        if self.queueHandler.grammarDeltas and self.lastSent and len(choices) > 0:
+            newSet = set(choices)
+            oldSet = set(self.lastSent)
+
+            removed = [choice for choice in self.lastSent if choice not in newSet]
+            added = [choice for choice in choices if choice not in oldSet]
+
+            # deltas are only worthwhile when smaller than the full grammar
+            if len(removed) + len(added) < len(choices):
+                if len(removed) > 0:
+                    self.write('grammarRemove', removed)
+                if len(added) > 0:
+                    self.write('grammarAdd', added)
+
+                metrics.inc('vios_grammar_updates_total', { 'kind': 'delta' })
+                self.mark_sent(choices)
+                return
+
+        self.write('grammarSet', choices)
+
+        metrics.inc('vios_grammar_updates_total', { 'kind': 'full' })
+        self.mark_sent(choices)
+
+    def mark_sent(self, choices):
+        self.lastSent = choices
+        self.lastSentTime = time.time()
+
+    def write(self, type, choices):
+        # build grammar choices into comma-delimited string
+        self.queueHandler.write(Message(self.pendingInstanceId,
+                                        type,
+                                        self.queueHandler.get_message_id(),
+                                        ','.join(choices)))
+
+    # forgets the engine's grammar, e.g. after dictation clears it, so the next
+    #  update is a full grammarSet
+    def reset(self):
+        self.lock.acquire()
+        self.lastSent = None
+        self.lock.release()
+
+# message types with a compact code in binary frames
+# append only: a type's position is its code on the wire, 0 marks a type sent by name
+BINARY_TYPES = ['', 'grammarMatch', 'dictationResult', 'grammarSet', 'speechSynth',
+                'synthesisDone', 'playerDone', 'recordDone', 'break',
+                'synthesisPause', 'synthesisResume', 'play', 'playAsync',
+                'pause', 'unpause', 'stop', 'back', 'skip', 'seek', 'volume',
+                'create', 'delete', 'record', 'startDictation', 'clearInstance',
+                'protocol', 'grammarAdd', 'grammarRemove', 'playNext',
+                'speechRender', 'promptPlay']
+BINARY_TYPE_CODES = dict((name, code) for code, name in enumerate(BINARY_TYPES) if name != '')
+
+# binary frame header: marker (0x80 | version), type code, instance id length,
+#  message id length, type name length. Followed by one UTF-8 body of instance
+#  id, message id, type name (code 0 only) and args
+# lengths count characters, so they are offsets into the decoded body, and the
+#  ids stay strings rather than being converted to ints and back
+# text frames start with '>', so the marker's high bit tells the formats apart
+# fields use the native byte order of the frame length, so a whole frame is
+#  packed at once with BINARY_FRAME_HEADER
+BINARY_VERSION = 2
+BINARY_MARKER = 0x80 | BINARY_VERSION
+BINARY_HEADER = struct.Struct('=BBBBH')
+BINARY_FRAME_HEADER = struct.Struct('=IBBBBH')
+
+# optional protocol features, offered as comma-separated args of a 'protocol'
+#  message; the engine replies with the subset it supports
+BINARY_PROTOCOL = 'binary/{0}'.format(BINARY_VERSION)
+GRAMMAR_DELTA_PROTOCOL = 'grammarDelta/1'
+PLAY_NEXT_PROTOCOL = 'playNext/1'
+PROMPT_RENDER_PROTOCOL = 'speechRender/1'
+PROTOCOL_FEATURES = [BINARY_PROTOCOL, GRAMMAR_DELTA_PROTOCOL, PLAY_NEXT_PROTOCOL, PROMPT_RENDER_PROTOCOL]
+
 class Message():
     def __init__(self, _instanceId = None, _type = None, _messageId = None, _args = None):
         self.instanceId = _instanceId
@@ -368,220 +1132,2096 @@ class Message():
                       self.type + '|' + \
                       self.messageId + '|' + \
                       self.args + '<<'
-                    
-class QueueHandler(threading.Thread):
-    def __init__(self, _recvPipe, _sendPipe):
-        threading.Thread.__init__(self)
-        
-        self.recvPipe = _recvPipe
-        self.sendPipe = _sendPipe
 
-        self.writeLock = threading.Lock()
+    # decodes a frame payload in either format: one header unpack and one decode
+    #  of the body, which the fields are sliced from
+    def from_bytes(self, buffer):
+        # legacy text frame
+        if len(buffer) == 0 or buffer[0] == 0x3e:
+            return self.from_str(str(buffer, 'ascii'))
 
-        self.nextInstanceId = 1
-        self.nextMessageId = 1
+        marker, typeCode, instanceLength, messageLength, typeLength = BINARY_HEADER.unpack_from(buffer)
+        if marker != BINARY_MARKER:
+            raise Exception('Unsupported binary frame version in Message(): {0}'.format(marker))
 
-        self.instanceRecvDequeDict = {}
+        body = str(buffer[BINARY_HEADER.size:], 'utf-8')
 
-        self.instanceLock = threading.Lock()
+        offset = instanceLength + messageLength
+        self.instanceId = body[:instanceLength]
+        self.messageId = body[instanceLength:offset]
 
-        # initialize GrammarMapper that helps manage grammars across apps
-        # this is attached to QueueHandler for convenient app access
-        self.grammarMapper = GrammarMapper()
+        if typeCode == 0:
+            self.type = body[offset:offset + typeLength]
+            offset += typeLength
+        else:
+            self.type = BINARY_TYPES[typeCode]
 
-    def get_instance_id(self):
-        instanceId = ''
-        self.instanceLock.acquire()
-        instanceId = str(self.nextInstanceId)
-        self.nextInstanceId += 1
-        self.instanceLock.release()
+        self.args = body[offset:]
 
-        return instanceId
+        return self
 
-    def get_message_id(self):
-        messageId = ''
-        self.instanceLock.acquire()
-        messageId = str(self.nextMessageId)
-        self.nextMessageId += 1
-        self.instanceLock.release()
+    # binary payload, without the frame length
+    def to_bytes(self):
+        return self.to_frame()[FRAME_HEADER.size:]
 
-        return messageId
+    # whole binary frame, length included, from one header pack and one encode
+    def to_frame(self):
+        typeCode = BINARY_TYPE_CODES.get(self.type, 0)
 
-    def register_instance(self, instanceId):
-        self.instanceLock.acquire()
-        self.instanceRecvDequeDict[instanceId] = collections.deque()
-        self.grammarMapper.register_instance(instanceId)
-        self.instanceLock.release()
+        if typeCode == 0:
+            body = (self.instanceId + self.messageId + self.type + self.args).encode('utf-8')
+            typeLength = len(self.type)
+        else:
+            body = (self.instanceId + self.messageId + self.args).encode('utf-8')
+            typeLength = 0
+
+        return BINARY_FRAME_HEADER.pack(BINARY_HEADER.size + len(body),
+                                        BINARY_MARKER,
+                                        typeCode,
+                                        len(self.instanceId),
+                                        len(self.messageId),
+                                        typeLength) + body
+                    
+# replies an app may be blocked on; a full mailbox never evicts these
+COMPLETION_TYPES = set(['synthesisDone', 'playerDone', 'recordDone'])
+
+# what a full mailbox does with a new message when nothing can be evicted:
+#  'drop-oldest' evicts the oldest message that isn't a completion or awaited
+#  'reject' discards the new message
+#  'block' makes the producer wait up to blockTimeout for a reader to make room,
+#   then falls back to 'drop-oldest'
+MAILBOX_POLICIES = ['drop-oldest', 'reject', 'block']
+
+# per-instance message queue that readers block on until a message is delivered
+# threaded readers wait on the condition, coroutine readers on a loop future
+# messages of latestTypes replace any queued message of the same type, so only
+#  the newest value of e.g. a status report is kept
+class Mailbox():
+    def __init__(self, maxLength = 10, policy = 'drop-oldest', latestTypes = (), blockTimeout = 1.0):
+        self.messages = collections.deque()
+
+        if policy not in MAILBOX_POLICIES:
+            raise ValueError('unknown mailbox policy: ' + policy)
+
+        self.maxLength = maxLength
+        self.policy = policy
+        self.latestTypes = set(latestTypes)
+        self.blockTimeout = blockTimeout
+
+        # set by QueueHandler.register_instance(), for logging
+        self.instanceId = None
+
+        # protects messages and signaled, and wakes blocked readers
+        self.condition = threading.Condition()
+
+        # (loop, future) pairs for coroutines awaiting this mailbox
+        self.asyncWaiters = []
+
+        # set by signal() to wake an interruptible read without a message
+        self.signaled = False
+
+        # messageId -> number of readers blocked in get() on it
+        self.awaitedIds = {}
+
+        # producers blocked in put() waiting for room
+        self.blockedProducers = 0
+
+        # reason -> messages discarded, and deepest the mailbox has been
+        self.dropCounts = {}
+        self.dropped = 0
+        self.highWater = 0
+
+    # wakes every threaded and coroutine reader. Caller holds condition
+    def notify(self):
+        self.condition.notify_all()
+
+        for loop, future in self.asyncWaiters:
+            loop.call_soon_threadsafe(wake_future, future)
+        self.asyncWaiters = []
+
+    # returns False if the message was rejected
+    # with block unset, the 'block' policy behaves like 'drop-oldest'
+    def put(self, message, block = True):
+        with self.condition:
+            if message.type in self.latestTypes:
+                for queued in self.messages:
+                    if queued.type == message.type:
+                        self.messages.remove(queued)
+                        self.count_drop('coalesced', queued)
+                        break
 
-    def run(self):
-        # start reader thread
-        self.readerThread = threading.Thread(target = self.process_reads)
-        self.readerThread.setDaemon(True)
-        self.readerThread.start()
+            if len(self.messages) >= self.maxLength and self.policy == 'block' and block:
+                self.blockedProducers += 1
+                try:
+                    self.condition.wait_for(lambda: len(self.messages) < self.maxLength,
+                                            self.blockTimeout)
+                finally:
+                    self.blockedProducers -= 1
 
-    # used to wake up sleeping apps on system shutdown
-    # possibly should become part of VIOSApp eventually
-    def wakeup(self, instanceId):
-        self.instanceRecvDequeDict[instanceId].append(Message(instanceId,
-                                                              'grammarMatch',
-                                                              self.get_message_id(),
-                                                              'wakeup'))
+            if len(self.messages) >= self.maxLength:
+                if self.policy == 'reject':
+                    self.count_drop('rejected', message)
+                    return False
 
-    def process_reads(self):
-        while True:
-            # deserialize a message from incoming pipe
-            message = Message().from_str(pipe_read(self.recvPipe))
+                # when everything queued is protected, the mailbox grows instead
+                victim = self.evictable()
+                if victim != None:
+                    self.messages.remove(victim)
+                    self.count_drop('evicted', victim)
 
-            # use GrammarMapper to look up receiving app for grammar matches
-            instanceRecvDeque = None
-            instanceId = None
-            try:
-                if message.type == 'grammarMatch':
-                    instanceId = self.grammarMapper.get_instance(message.args)
-                elif message.type == 'dictationResult':
-                    instanceId = self.grammarMapper.activeApp.instanceId
-                else:
-                    # for all other msgs, rely on message's instance id
-                    instanceId = message.instanceId
-            except:
-                log_msg('Caught exception in QueueHandler while looking up instance: {0}'.format(message.to_str()))
+            self.messages.append(message)
+
+            if len(self.messages) > self.highWater:
+                self.highWater = len(self.messages)
 
-            if instanceId is not None:
-                instanceRecvDeque = self.instanceRecvDequeDict[instanceId]
+            self.notify()
 
-            # GrammarMapper should never not return a valid instance
-            if instanceRecvDeque == None:
-                log_msg('process_reads(): no instanceRecvDeque found. Dumping grammarMapper:\n{0}'.format(self.grammarMapper.dump()))
+        return True
 
-            # perform proxy function by placing message on instance's deque
-            instanceRecvDeque.append(message)
+    # oldest message that isn't a completion or awaited by a reader. Caller holds condition
+    def evictable(self):
+        for message in self.messages:
+            if message.type not in COMPLETION_TYPES and message.messageId not in self.awaitedIds:
+                return message
 
-            log_msg('Message delivered to instance {0}'.format(instanceId))
+        return None
 
-            # drop oldest message if instance's deque exceeds maximum
-            if len(instanceRecvDeque) > 10:
-                instanceRecvDeque.popleft()
+    # caller holds condition
+    def count_drop(self, reason, message):
+        self.dropCounts[reason] = self.dropCounts.get(reason, 0) + 1
+        self.dropped += 1
 
-            # avoid busy loop
-            time.sleep(.1)
+        # replacing a stale value is routine, losing a message is not
+        level = WARNING
+        if reason == 'coalesced':
+            level = DEBUG
 
-    # performs a blocking or non-blocking Message object read for a given instance
-    def read(self, instanceId, messageId = None, block = True):
-# TODO: verify or fix for thread-safety ...
-        # reference instance-specific deque
-        recvDeque = self.instanceRecvDequeDict[instanceId]
+        log_msg('Mailbox {0}: {1} message {2}'.format(self.instanceId, reason, message.to_str()), level, 'queue')
 
-        # Either pull messageId-specific message or just any instance message
-        message = None
+    def signal(self):
+        with self.condition:
+            self.signaled = True
+            self.notify()
+
+    # removes and returns a matching message, or None. Caller holds condition
+    def take(self, messageId):
         if messageId == None:
+            if len(self.messages) > 0:
+                return self.removed(self.messages.pop())
+
+            return None
+
+        # NOTE: due to a change to handling multiple grammar sets, namely
+        #  handling it now on the python-side rather than in .Net, this does
+        #  not filter based on MessageId if the message is a grammarMatch. The
+        #  reason for this is that the .Net code is no longer remembering the
+        #  mapping from a grammar match to a particular app/message. Now only
+        #  the python code knows that relationship.
+        # Essentially now when an app calls read(messageId), it will always
+        #  return if there is any grammar match belonging to the app. So,
+        #  this means the same app could not have two reads blocking on
+        #  different messageIds. I don't think this currently poses an issue.
+        for msg in self.messages:
+            if msg.messageId == messageId or msg.type == 'grammarMatch' or msg.type == 'dictationResult':
+                # pop matching message from middle of deque
+                self.messages.remove(msg)
+                return self.removed(msg)
+
+        return None
+
+    # lets a producer blocked on a full mailbox continue. Caller holds condition
+    def removed(self, message):
+        if self.blockedProducers > 0:
+            self.condition.notify_all()
+
+        return message
+
+    # returns (ready, result) for wait_any(). Caller holds condition
+    def poll_any(self, completions, grammar, interruptible):
+        for completion in completions:
+            if completion.done():
+                return True, completion
+
+        if grammar:
+            message = self.take(None)
+            if message != None:
+                return True, message
+
+        if interruptible and self.signaled:
+            self.signaled = False
+            return True, None
+
+        return False, None
+
+    # returns (ready, result) for get(). Caller holds condition
+    def poll_get(self, messageId, block, interruptible):
+        message = self.take(messageId)
+        if message != None or block == False:
+            return True, message
+
+        if interruptible and self.signaled:
+            self.signaled = False
+            return True, None
+
+        return False, None
+
+    # blocks until one of completions is resolved or, if grammar is set, until a
+    #  grammar match or other unsolicited message arrives. Returns whichever
+    #  Completion or Message came first
+    def wait_any(self, completions, grammar = True, interruptible = False):
+        with self.condition:
+            while True:
+                ready, result = self.poll_any(completions, grammar, interruptible)
+                if ready:
+                    return result
+
+                self.condition.wait()
+
+    # returns a matching message, blocking until one is delivered if requested
+    # an interruptible get returns None once the mailbox has been signaled
+    def get(self, messageId = None, block = True, interruptible = False):
+        with self.condition:
+            ready, result = self.poll_get(messageId, block, interruptible)
+            if ready:
+                return result
+
+            # keep the awaited reply safe from eviction while blocked
+            self.track_awaited(messageId, 1)
             try:
-                message = recvDeque.pop()
-            except:
-                # implement blocking message retrieval
-                while block:
-                    time.sleep(.2)
-                    try:
-                        message = recvDeque.pop()
-                        break
-                    except:
-                        pass
+                while True:
+                    self.condition.wait()
+
+                    ready, result = self.poll_get(messageId, block, interruptible)
+                    if ready:
+                        return result
+            finally:
+                self.track_awaited(messageId, -1)
+
+    # counts readers blocked on messageId. Caller holds condition
+    def track_awaited(self, messageId, delta):
+        if messageId == None:
+            return
+
+        count = self.awaitedIds.get(messageId, 0) + delta
+        if count > 0:
+            self.awaitedIds[messageId] = count
         else:
-            # NOTE: due to a change to handling multiple grammar sets, namely
-            #  handling it now on the python-side rather than in .Net, I am
-            #  going to have to hack a change in below to not filter based on
-            #  MessageId if the message is a grammarMatch. The reason for this
-            #  is that the .Net code is no longer remembering the mapping
-            #  from a grammar match to a particular app/message. Now only the
-            #  python code knows that relationship.
-            # Essentially now when an app calls read(messageId), it will always
-            #  return if there is any grammar match belonging to the app. So,
-            #  this means the same app could not have two reads blocking on
-            #  different messageIds. I don't think this currently poses an issue.
-           
-            # iterate searching for messageId match
-            for msg in recvDeque:
-                if msg.messageId == messageId or msg.type == 'grammarMatch' or msg.type == 'dictationResult':
-                    # pop matching message from middle of deque
-                    message = msg
-                    recvDeque.remove(msg)
-                    break
+            self.awaitedIds.pop(messageId, None)
+
+    # coroutine version of wait_any()
+    async def wait_any_async(self, completions, grammar = True, interruptible = False):
+        return await self.poll_async(self.poll_any, completions, grammar, interruptible)
+
+    # coroutine version of get()
+    async def get_async(self, messageId = None, block = True, interruptible = False):
+        with self.condition:
+            self.track_awaited(messageId, 1)
+        try:
+            return await self.poll_async(self.poll_get, messageId, block, interruptible)
+        finally:
+            with self.condition:
+                self.track_awaited(messageId, -1)
 
-            if message == None:
-                # implement blocking message retrieval
-                while block:
-                    time.sleep(.2)
-                    for msg in recvDeque:
-                        if msg.messageId == messageId or msg.type == 'grammarMatch' or msg.type == 'dictationResult':
-                            # pop matching message from middle of deque
-                            message = msg
-                            recvDeque.remove(msg)
-                            break
-
-                    # break out of block loop
-                    if message != None:
-                        break
+    # repeats poll until ready, awaiting a notify() between attempts
+    async def poll_async(self, poll, *args):
+        loop = asyncio.get_running_loop()
+        while True:
+            with self.condition:
+                ready, result = poll(*args)
+                if ready:
+                    return result
 
-        return message
+                future = loop.create_future()
+                self.asyncWaiters.append((loop, future))
 
-    # thread-protected write on shared pipe
-    def write(self, message):
-        self.writeLock.acquire()
-        pipe_write(self.sendPipe, message.to_str())
-        self.writeLock.release()
+            await future
 
-# writes msg to pipe using simple protocol of length followed by msg
-def pipe_write(pipe, writeString):
-    log_msg('Sending message: ' + writeString)
-    
-    # write string length followed by string
-    pipe.write(struct.pack('I', len(writeString)) + writeString.encode('ascii'))
-    pipe.seek(0)
+# handle for a single outstanding command, resolved by the reply carrying its messageId
+# shares its mailbox's condition so a reader can wait on completions and grammar input together
+class Completion():
+    def __init__(self, _mailbox, _command):
+        self.mailbox = _mailbox
+        self.command = _command
+        self.messageId = _command.messageId
 
-# reads msg from pipe using simple protocol of length followed by msg
-def pipe_read(pipe):
-    # read length of expected
-    readBytes = pipe.read(4)
-    
-    # seek to beginning of stream
-    pipe.seek(0)
+        # reply Message, set once the engine answers
+        self.message = None
 
-    # error check
-    bytesRead = len(readBytes)
-    if len(readBytes) < 4:
-        log_msg('Returned {0} bytes, expecting 4.'.format(len(readBytes)))
+        # registered just before the command is written, and when the reply arrived
+        self.startTime = time.time()
+        self.resultTime = None
 
-        if bytesRead == 0:
-            raise NameError('Error on connection.')
-    
-        return ''
+        # called with the completion on the reader thread once the reply arrives
+        self.callback = None
 
-    # convert length
-    stringLength = struct.unpack('I', readBytes)[0]
+    def done(self):
+        return self.message != None
 
-    # read expected number of bytes
-    bytesRead = 0
-    readBytes = bytes()
-    currentReadBytes = []
-    while (bytesRead < stringLength):
-        currentReadBytes = pipe.read(stringLength - bytesRead)
+    def set_result(self, message):
+        metrics.observe('vios_command_latency_seconds', time.time() - self.startTime, { 'type': self.command.type })
 
-        # seek to beginning of stream
-        pipe.seek(0)
+        with self.mailbox.condition:
+            self.resultTime = time.time()
+            self.message = message
+            self.mailbox.notify()
 
-        if len(currentReadBytes) == 0:
-            log_msg('0 bytes read error.')
-            return ''
+        if self.callback != None:
+            self.callback(self)
 
-        readBytes = readBytes + currentReadBytes
+    # blocks until the reply arrives and returns its args
+    def wait(self, timeout = None):
+        with self.mailbox.condition:
+            self.mailbox.condition.wait_for(self.done, timeout)
 
-        bytesRead += len(currentReadBytes)
-        
-    # convert string
-    readString = readBytes.decode('ascii')
+        if self.message == None:
+            return None
 
-    log_msg('Read message: ' + readString)
+        return self.message.args
 
-    return readString
+    # coroutine version of wait()
+    async def wait_async(self):
+        await self.mailbox.wait_any_async([self], grammar = False)
+
+        return self.message.args
+
+# completion of an utterance queued with SpeechQueue; resolves with
+#  'synthesis done' once it has been spoken, 'speech cancelled', or
+#  'speech deferred' if the app was in the background
+class SpeechHandle(Completion):
+    def __init__(self, _mailbox, _instanceId, _text, _merge = True):
+        Completion.__init__(self, _mailbox, Message(_instanceId, 'speechSynth', None, _text))
+
+        self.text = _text
+
+        # whether the utterance may be spoken as part of one speechSynth with
+        #  its neighbours
+        self.merge = _merge
+
+    def finish(self, args):
+        with self.mailbox.condition:
+            self.resultTime = time.time()
+            self.message = Message(self.command.instanceId, 'speechSynth', None, args)
+            self.mailbox.notify()
+
+# an app's utterances on their way to the engine, so synthesize() returns at once
+#  instead of blocking for the synthesizer to become free
+# one synthesisDone request is kept outstanding while anything is queued or
+#  being spoken. When it's answered, the spoken utterances are finished and
+#  the utterances queued meanwhile go out merged into one speechSynth
+# flush() cancels queued and spoken utterances, e.g. on barge-in
+class SpeechQueue():
+    def __init__(self, queueHandler, instanceId, mailbox, appName):
+        self.queueHandler = queueHandler
+        self.instanceId = instanceId
+        self.appName = appName
+
+        # the app's mailbox, notified as handles resolve
+        self.mailbox = mailbox
+
+        # replies to synthesisDone requests go here, so they don't wake the app
+        self.replyMailbox = Mailbox()
+
+        # handles not yet sent, and handles of the utterance being spoken
+        self.queued = []
+        self.speaking = []
+
+        # outstanding synthesisDone Completion, if any, and QueueHandler.speechCount
+        #  when it was requested
+        self.availability = None
+        self.requestSpeechCount = 0
+
+        self.lock = threading.Lock()
+
+    # queues text and returns its SpeechHandle
+    def submit(self, text, merge = True):
+        handle = SpeechHandle(self.mailbox, self.instanceId, text, merge)
+
+        with self.lock:
+            self.queued.append(handle)
+
+            if self.availability == None:
+                self.request_availability()
+
+        return handle
+
+    # resolves a backgrounded app's utterance at once with 'speech deferred'
+    def defer(self, text):
+        metrics.inc('vios_speech_deferred_total', { 'app': self.appName })
+
+        handle = SpeechHandle(self.mailbox, self.instanceId, text)
+        handle.finish('speech deferred')
+
+        return handle
+
+    # cancels every queued and spoken utterance; the caller stops the engine's
+    #  synthesis with 'break'
+    def flush(self):
+        with self.lock:
+            cancelled = self.queued + self.speaking
+            self.queued = []
+            self.speaking = []
+
+        for handle in cancelled:
+            handle.finish('speech cancelled')
+
+    def pending(self):
+        with self.lock:
+            return len(self.queued) + len(self.speaking)
+
+    # caller holds lock
+    def request_availability(self):
+        command = Message(self.instanceId, 'synthesisDone', self.queueHandler.get_message_id(), '')
+
+        self.requestSpeechCount = self.queueHandler.speechCount
+
+        self.availability = self.queueHandler.register_completion(command, self.replyMailbox)
+        self.availability.callback = self.available
+
+        self.queueHandler.write(command)
+
+    # takes the longest run of queued utterances that can be merged. A rendered
+    #  prompt goes alone, as merging would turn it into new text to synthesize,
+    #  as does an utterance submitted with merge False
+    # caller holds lock
+    def next_batch(self):
+        promptCache = self.queueHandler.promptCache
+
+        def mergeable(handle):
+            return handle.merge and (promptCache == None or not promptCache.contains(handle.text))
+
+        count = 1
+        if mergeable(self.queued[0]):
+            while count < len(self.queued) and mergeable(self.queued[count]):
+                count += 1
+
+        batch = self.queued[:count]
+        del self.queued[:count]
+
+        return batch
+
+    # runs on the reader thread when the synthesizer is free
+    def available(self, completion):
+        with self.queueHandler.speechLock:
+            with self.lock:
+                if completion != self.availability:
+                    return
+
+                self.availability = None
+
+                spoken = self.speaking
+                self.speaking = []
+
+                if len(self.queued) > 0:
+                    if self.queueHandler.speechCount != self.requestSpeechCount:
+                        # another app has spoken since the request went out, so the
+                        #  synthesizer may be busy again
+                        self.request_availability()
+                    else:
+                        batch = self.next_batch()
+
+                        metrics.observe('vios_synthesis_wait_seconds', time.time() - batch[0].startTime, { 'app': self.appName })
+                        metrics.inc('vios_speech_utterances_total', { 'app': self.appName }, len(batch))
+
+                        text = ' '.join(handle.text for handle in batch)
+                        self.queueHandler.write(self.queueHandler.speech_message(self.instanceId, text))
+                        self.queueHandler.speechCount += 1
+
+                        self.speaking = batch
+                        self.request_availability()
+
+        for handle in spoken:
+            handle.finish('synthesis done')
+
+class QueueHandler(threading.Thread):
+    def __init__(self, _recvPipe, _sendPipe):
+        threading.Thread.__init__(self)
+        
+        self.recvPipe = _recvPipe
+        self.sendPipe = _sendPipe
+
+        # frames waiting for the writer thread, with their optional WriteHandles
+        self.outboundDeque = collections.deque()
+        self.outboundCondition = threading.Condition()
+
+        # set while the writer thread has frames in flight
+        self.writing = False
+
+        self.nextInstanceId = 1
+        self.nextMessageId = 1
+
+        self.instanceMailboxDict = {}
+
+        # outstanding commands awaiting a reply, keyed by messageId
+        self.pendingDict = {}
+
+        # outbound frame format. Inbound frames of either format are always accepted
+        self.binaryFrames = False
+
+        # set if the engine accepts grammarAdd/grammarRemove deltas
+        self.grammarDeltas = False
+
+        # set if the engine can queue the next track with playNext
+        self.preloadTracks = False
+
+        # PromptCache of rendered prompts, if the engine can render speech to files
+        self.promptCache = None
+
+        # speech commands sent by SpeechQueues, which only send while holding
+        #  speechLock; the engine has one synthesizer shared by every app
+        self.speechCount = 0
+        self.speechLock = threading.Lock()
+
+        self.instanceLock = threading.Lock()
+
+        # event loop hosting coroutine apps, started on first use by get_loop()
+        self.loop = None
+        self.loopLock = threading.Lock()
+
+        # initialize GrammarMapper that helps manage grammars across apps
+        # this is attached to QueueHandler for convenient app access
+        self.grammarMapper = GrammarMapper()
+
+        # sends the mapper's grammar to the engine
+        self.grammarSync = GrammarSync(self)
+
+        # Mailbox() keyword arguments for every instance, e.g. { 'policy': 'block' }
+        self.mailboxDefaults = {}
+
+        # whether dispatch may wait for room in a mailbox with the 'block' policy
+        self.blockingPuts = True
+
+        metrics.add_collector(self.collect_metrics)
+
+    def get_instance_id(self):
+        instanceId = ''
+        self.instanceLock.acquire()
+        instanceId = str(self.nextInstanceId)
+        self.nextInstanceId += 1
+        self.instanceLock.release()
+
+        return instanceId
+
+    def get_message_id(self):
+        messageId = ''
+        self.instanceLock.acquire()
+        messageId = str(self.nextMessageId)
+        self.nextMessageId += 1
+        self.instanceLock.release()
+
+        return messageId
+
+    # mailboxOptions are Mailbox() keyword arguments, overriding mailboxDefaults
+    def register_instance(self, instanceId, mailboxOptions = None):
+        options = dict(self.mailboxDefaults)
+        options.update(mailboxOptions or {})
+
+        mailbox = Mailbox(**options)
+        mailbox.instanceId = instanceId
+
+        self.instanceLock.acquire()
+        self.instanceMailboxDict[instanceId] = mailbox
+        self.grammarMapper.register_instance(instanceId)
+        self.instanceLock.release()
+
+    # registers a command's messageId so its reply is routed straight to the returned Completion
+    # must happen before the command is written so a fast reply can't be missed
+    def register_completion(self, command, mailbox = None):
+        if mailbox == None:
+            mailbox = self.instanceMailboxDict[command.instanceId]
+
+        completion = Completion(mailbox, command)
+
+        self.instanceLock.acquire()
+        self.pendingDict[command.messageId] = completion
+        self.instanceLock.release()
+
+        return completion
+
+    # offers the engine PROTOCOL_FEATURES, falling back to the plain text protocol
+    #  for anything it doesn't accept within timeout (the .Net client ignores
+    #  unknown message types, so it never answers)
+    # must be called after the reader has started
+    def negotiate(self, timeout = 1.0):
+        command = Message('0', 'protocol', self.get_message_id(), ','.join(PROTOCOL_FEATURES))
+        completion = self.register_completion(command, Mailbox())
+
+        self.write(command)
+
+        accepted = []
+        reply = completion.wait(timeout)
+        if reply != None:
+            accepted = reply.split(',')
+        else:
+            self.instanceLock.acquire()
+            self.pendingDict.pop(command.messageId, None)
+            self.instanceLock.release()
+
+        self.binaryFrames = BINARY_PROTOCOL in accepted
+        self.grammarDeltas = GRAMMAR_DELTA_PROTOCOL in accepted
+        self.preloadTracks = PLAY_NEXT_PROTOCOL in accepted
+
+        if PROMPT_RENDER_PROTOCOL in accepted and self.promptCache == None:
+            try:
+                self.promptCache = PromptCache(self, os.path.join(data_directory(), 'prompts'))
+            except ValueError as e:
+                log_msg('Not caching prompts: {0}'.format(e), WARNING)
+
+        log_msg('Negotiated protocol features: {0}'.format(accepted))
+
+        return accepted
+
+    # speaks text: plays its rendered audio if the prompt cache has it, or
+    #  synthesizes it
+    def speech_message(self, instanceId, text):
+        if self.promptCache != None:
+            path = self.promptCache.lookup(text)
+            if path != None:
+                return Message(instanceId, 'promptPlay', self.get_message_id(), path)
+
+        return Message(instanceId, 'speechSynth', self.get_message_id(), text)
+
+    # serializes a message into a frame in the negotiated outbound format
+    def encode_frame(self, message):
+        if self.binaryFrames:
+            return message.to_frame()
+
+        return pack_frame(message.to_str().encode('ascii'))
+
+    def run(self):
+        # start reader thread
+        self.readerThread = threading.Thread(target = self.process_reads)
+        self.readerThread.setDaemon(True)
+        self.readerThread.start()
+
+        # start writer thread
+        self.writerThread = threading.Thread(target = self.process_writes)
+        self.writerThread.setDaemon(True)
+        self.writerThread.start()
+
+    # returns the event loop AsyncVIOSApps run on, starting it on a daemon thread if needed
+    def get_loop(self):
+        self.loopLock.acquire()
+        try:
+            if self.loop == None:
+                self.loop = asyncio.new_event_loop()
+
+                loopThread = threading.Thread(target = self.loop.run_forever)
+                loopThread.daemon = True
+                loopThread.start()
+        finally:
+            self.loopLock.release()
+
+        return self.loop
+
+    # used to wake up sleeping apps on system shutdown
+    # possibly should become part of VIOSApp eventually
+    def wakeup(self, instanceId):
+        self.instanceMailboxDict[instanceId].put(Message(instanceId,
+                                                         'grammarMatch',
+                                                         self.get_message_id(),
+                                                         'wakeup'))
+
+    # wakes an interruptible read on the shell without delivering a message
+    # used to tell the shell an app has been backgrounded or has exited
+    def notify_lifecycle(self):
+        shellMailbox = self.instanceMailboxDict.get('1')
+        if shellMailbox is not None:
+            shellMailbox.signal()
+
+    # reads and dispatches frames as fast as the engine delivers them
+    # FrameReader blocks until the next frame is available, so no delay is needed
+    def process_reads(self):
+        for readBytes in FrameReader(self.recvPipe).frames():
+            # deserialize a message from incoming pipe
+            message = Message().from_bytes(readBytes)
+
+            log_frame('<', message)
+
+            self.dispatch(message)
+
+        log_msg('process_reads(): connection closed.')
+
+    # routes a single incoming message to the mailbox of the instance it belongs to
+    def dispatch(self, message):
+        metrics.inc('vios_messages_received_total', { 'type': message.type })
+
+        # replies to registered commands go straight to their waiter
+        if message.type != 'grammarMatch' and message.type != 'dictationResult':
+            self.instanceLock.acquire()
+            completion = self.pendingDict.pop(message.messageId, None)
+            self.instanceLock.release()
+
+            if completion != None:
+                completion.set_result(message)
+
+                log_msg('Message completed for instance {0}'.format(completion.command.instanceId), DEBUG, 'queue')
+                return
+
+        # use GrammarMapper to look up receiving app for grammar matches
+        instanceMailbox = None
+        instanceId = None
+        try:
+            if message.type == 'grammarMatch':
+                instanceId = self.grammarMapper.get_instance(message.args)
+            elif message.type == 'dictationResult':
+                instanceId = self.grammarMapper.activeApp.instanceId
+            else:
+                # for all other msgs, rely on message's instance id
+                instanceId = message.instanceId
+        except:
+            log_msg('Caught exception in QueueHandler while looking up instance: {0}'.format(message.to_str()), ERROR)
+
+        if instanceId is not None:
+            instanceMailbox = self.instanceMailboxDict.get(instanceId)
+
+        # GrammarMapper should never not return a valid instance
+        if instanceMailbox == None:
+            log_msg('dispatch(): no instanceMailbox found. Dumping grammarMapper:\n{0}'.format(self.grammarMapper.dump()), ERROR)
+            log_recent_frames('dispatch(): undeliverable message')
+            metrics.inc('vios_messages_undeliverable_total', { 'type': message.type })
+            return
+
+        # perform proxy function by placing message in instance's mailbox,
+        #  which immediately wakes any reader blocked on it
+        instanceMailbox.put(message, self.blockingPuts)
+
+        metrics.inc('vios_messages_delivered_total', { 'instance': instanceId })
+
+        log_msg('Message delivered to instance {0}'.format(instanceId), DEBUG, 'queue')
+
+    # performs a blocking or non-blocking Message object read for a given instance
+    # an interruptible read also returns None when the instance's mailbox is signaled
+    def read(self, instanceId, messageId = None, block = True, interruptible = False):
+        return self.instanceMailboxDict[instanceId].get(messageId, block, interruptible)
+
+    # queues message for the writer thread and returns immediately
+    # if handle is set, returns a WriteHandle that completes once the frame is written
+    def write(self, message, handle = False):
+        log_frame('>', message)
+        metrics.inc('vios_messages_sent_total', { 'type': message.type })
+
+        writeHandle = None
+        if handle:
+            writeHandle = WriteHandle()
+
+        frame = self.encode_frame(message)
+
+        with self.outboundCondition:
+            self.outboundDeque.append((frame, writeHandle))
+            self.outboundCondition.notify_all()
+
+        return writeHandle
+
+    # number of frames queued but not yet handed to the pipe
+    def outbound_depth(self):
+        return len(self.outboundDeque)
+
+    # samples read when metrics are rendered
+    def collect_metrics(self):
+        samples = [('vios_outbound_depth', 'gauge', None, self.outbound_depth()),
+                   ('vios_pending_commands', 'gauge', None, len(self.pendingDict)),
+                   ('vios_grammar_phrases', 'gauge', None, len(self.grammarMapper.get_grammar()))]
+
+        if self.promptCache != None:
+            samples.append(('vios_prompt_cache_entries', 'gauge', None, len(self.promptCache.entries)))
+
+        for instanceId, mailbox in list(self.instanceMailboxDict.items()):
+            labels = { 'instance': instanceId }
+            samples.append(('vios_mailbox_depth', 'gauge', labels, len(mailbox.messages)))
+            samples.append(('vios_mailbox_high_water', 'gauge', labels, mailbox.highWater))
+            for reason, count in list(mailbox.dropCounts.items()):
+                samples.append(('vios_mailbox_dropped_total', 'counter', { 'instance': instanceId, 'reason': reason }, count))
+
+        return samples
+
+    # blocks until every queued frame has been written, or timeout expires
+    def flush(self, timeout = None):
+        with self.outboundCondition:
+            return self.outboundCondition.wait_for(lambda: len(self.outboundDeque) == 0 and self.writing == False,
+                                                   timeout)
+
+    # called once the apps are done with the engine: writes what's queued, up to
+    #  timeout. The reader and writer threads are daemons blocked on the pipes,
+    #  so they end with the process
+    def close(self, timeout = None):
+        return self.flush(timeout)
+
+    # drains all pending frames into a single write on the shared pipe
+    def process_writes(self):
+        while True:
+            with self.outboundCondition:
+                self.outboundCondition.wait_for(lambda: len(self.outboundDeque) > 0)
+
+                batch = list(self.outboundDeque)
+                self.outboundDeque.clear()
+                self.writing = True
+
+            metrics.observe('vios_write_batch_frames', len(batch))
+
+            error = None
+            try:
+                write_all(self.sendPipe, b''.join(frame for frame, writeHandle in batch))
+                seek_start(self.sendPipe)
+            except (OSError, ValueError) as e:
+                error = e
+                log_msg('process_writes(): error writing {0} frames: {1}'.format(len(batch), e), ERROR)
+
+            for frame, writeHandle in batch:
+                if writeHandle != None:
+                    writeHandle.set_done(error)
+
+            with self.outboundCondition:
+                self.writing = False
+                self.outboundCondition.notify_all()
+
+# completion handle for a queued outbound frame
+class WriteHandle():
+    def __init__(self):
+        self.event = threading.Event()
+
+        # exception raised by the write, if it failed
+        self.error = None
+
+    def done(self):
+        return self.event.is_set()
+
+    def set_done(self, error = None):
+        self.error = error
+        self.event.set()
+
+    # blocks until the frame is written. Returns False on timeout or write failure
+    def wait(self, timeout = None):
+        return self.event.wait(timeout) and self.error == None
+
+# QueueHandler that reads and writes frames with asyncio streams on its event loop
+# connect is a coroutine function returning a (StreamReader, StreamWriter) pair,
+#  e.g. lambda: asyncio.open_unix_connection(path)
+# threaded VIOSApps keep working unchanged: write() is safe to call from any thread
+#  and their mailboxes are shared with coroutine readers
+class AsyncQueueHandler(QueueHandler):
+    def __init__(self, _connect):
+        QueueHandler.__init__(self, None, None)
+
+        self.connect = _connect
+
+        self.reader = None
+        self.writer = None
+
+        # frames written before the streams were connected
+        self.heldFrames = []
+
+        # dispatch runs on the loop, which readers making room would also need
+        self.blockingPuts = False
+
+        # task running process_reads_async(), cancelled by close()
+        self.readerTask = None
+
+    def run(self):
+        # start reader coroutine
+        self.readerFuture = asyncio.run_coroutine_threadsafe(self.process_reads_async(),
+                                                             self.get_loop())
+
+    async def process_reads_async(self):
+        self.readerTask = asyncio.current_task()
+
+        self.reader, self.writer = await self.connect()
+
+        # send anything apps wrote while connecting
+        heldFrames = self.heldFrames
+        self.heldFrames = []
+        for frame, writeHandle in heldFrames:
+            self.write_frame(frame, writeHandle)
+
+        while True:
+            try:
+                readBytes = await read_frame(self.reader)
+            except asyncio.IncompleteReadError:
+                log_msg('process_reads_async(): connection closed.')
+                return
+
+            # deserialize a message from incoming stream
+            message = Message().from_bytes(readBytes)
+
+            log_frame('<', message)
+
+            self.dispatch(message)
+
+    # hands frame to the stream writer, hopping onto the loop thread if necessary
+    # the stream transport coalesces frames written in the same loop iteration
+    def write(self, message, handle = False):
+        log_frame('>', message)
+        metrics.inc('vios_messages_sent_total', { 'type': message.type })
+
+        writeHandle = None
+        if handle:
+            writeHandle = WriteHandle()
+
+        frame = self.encode_frame(message)
+
+        if on_loop(self.loop):
+            self.write_frame(frame, writeHandle)
+        else:
+            self.get_loop().call_soon_threadsafe(self.write_frame, frame, writeHandle)
+
+        return writeHandle
+
+    # runs on the loop thread. Frames written before connect() returns are held
+    def write_frame(self, frame, writeHandle):
+        if self.writer == None:
+            self.heldFrames.append((frame, writeHandle))
+            return
+
+        self.writer.write(frame)
+
+        if writeHandle != None:
+            writeHandle.set_done()
+
+    def outbound_depth(self):
+        if self.writer == None:
+            return 0
+
+        return self.writer.transport.get_write_buffer_size()
+
+    def flush(self, timeout = None):
+        if self.writer == None:
+            return True
+
+        future = asyncio.run_coroutine_threadsafe(self.writer.drain(), self.loop)
+        try:
+            future.result(timeout)
+        except Exception:
+            return False
+
+        return True
+
+    # drains the stream, then cancels the reader coroutine and waits for it to
+    #  end, so it isn't left pending on the loop. Call from outside the loop
+    def close(self, timeout = None):
+        if self.loop == None:
+            return True
+
+        future = asyncio.run_coroutine_threadsafe(self.close_async(), self.loop)
+        try:
+            future.result(timeout)
+        except Exception:
+            return False
+
+        return True
+
+    async def close_async(self):
+        if self.writer != None:
+            await self.writer.drain()
+
+        if self.readerTask != None and not self.readerTask.done():
+            self.readerTask.cancel()
+            try:
+                await self.readerTask
+            except asyncio.CancelledError:
+                pass
+
+    # writes from a coroutine on the handler's loop, waiting for the stream to drain
+    async def write_async(self, message):
+        self.write(message)
+
+        await self.writer.drain()
+
+# VIOSApp that runs as a coroutine on its QueueHandler's event loop instead of a thread
+# synthesize(), read(), wait_any(), grammar_prompt_and_read() and start_dictation()
+#  are awaitable. Subclasses implement main() as a coroutine
+class AsyncVIOSApp(VIOSApp):
+    def __init__(self, _queueHandler):
+        VIOSApp.__init__(self, _queueHandler)
+
+        # concurrent.futures.Future for run_async(), set by start()
+        self.task = None
+
+    # schedules the app on the event loop; mirrors Thread.start() so the shell
+    #  can launch threaded and coroutine apps the same way
+    def start(self):
+        self.task = asyncio.run_coroutine_threadsafe(self.run_async(),
+                                                     self.queueHandler.get_loop())
+
+    def join(self, timeout = None):
+        if self.task != None:
+            self.task.result(timeout)
+
+    def is_alive(self):
+        return self.task != None and self.task.done() == False
+
+    # runs a blocking call, e.g. file I/O, off the loop so the other apps on it
+    #  keep running. Uses the scheduler's worker pool, or the loop's default one
+    async def run_blocking(self, function, *args):
+        executor = None
+        if self.scheduler != None:
+            executor = self.scheduler.get_executor()
+
+        return await asyncio.get_running_loop().run_in_executor(executor, function, *args)
+
+    async def run_async(self):
+        VIOSApp.run(self)
+
+        await self.main()
+
+        self.cleanup()
+
+    async def main(self):
+        pass
+
+    def foreground(self):
+        self.active = True
+        self.queueHandler.grammarMapper.activeApp = self
+
+        # re-activate grammar
+        self.set_choices(self.choices)
+
+        # re-synthesize last output
+        if self.lastSynthesis != '':
+            asyncio.run_coroutine_threadsafe(self.synthesize(self.lastSynthesis),
+                                             self.queueHandler.get_loop())
+
+    async def synthesize(self, text, merge = True):
+        if self.initialized == False:
+            return
+
+        # remember text in case it must be re-synthesized when app is foregrounded
+        self.lastSynthesis = text
+
+        # a backgrounded app isn't heard, so its output is only remembered, newest
+        #  replacing older, and spoken by foreground()
+        if self.active == False:
+            return self.speechQueue.defer(text)
+
+        return self.speechQueue.submit(text, merge)
+
+    async def speak_listing(self, entries, choices, pageSize = LISTING_PAGE_SIZE, numbered = False):
+        if self.initialized == False:
+            return None
+
+        pageCount = max(1, (len(entries) + pageSize - 1) // pageSize)
+        self.set_choices(list(choices) + listing_commands(pageCount))
+
+        page = 0
+        spoken = await self.synthesize(listing_page(entries, page, pageSize, numbered), merge = False)
+        while self.interrupted == False:
+            following = None
+            if page + 1 < pageCount:
+                following = await self.synthesize(listing_page(entries, page + 1, pageSize, numbered), merge = False)
+
+            result = await self.wait_any([spoken])
+
+            if result == 'synthesis done':
+                if following == None:
+                    return None
+
+                page += 1
+                spoken = following
+            elif result in ('speech cancelled', 'speech deferred') or result == None:
+                return None
+            else:
+                self.break_speech()
+
+                target = listing_target(result, page, pageCount)
+                if target == None:
+                    return result
+
+                page = target
+                spoken = await self.synthesize(listing_page(entries, page, pageSize, numbered), merge = False)
+
+        return None
+
+    async def wait_any(self, completions, grammar = True, interruptible = False):
+        if self.initialized == False:
+            return None
+
+        mailbox = self.queueHandler.instanceMailboxDict[self.instanceId]
+
+        # the loop runs other apps until this one's mailbox is notified
+        self.waiting = True
+        try:
+            result = await mailbox.wait_any_async(completions, grammar, interruptible)
+        finally:
+            self.waiting = False
+
+        if isinstance(result, Completion):
+            return result.message.args
+        elif result != None:
+            return result.args
+
+        return None
+
+    async def read(self, messageId = None, block = True, interruptible = False):
+        if self.initialized == False:
+            return None
+
+        mailbox = self.queueHandler.instanceMailboxDict[self.instanceId]
+
+        self.waiting = True
+        try:
+            result = await mailbox.get_async(messageId, block, interruptible)
+        finally:
+            self.waiting = False
+
+        if result != None:
+            return result.args
+
+        return None
+
+    async def grammar_prompt_and_read(self, newChoices, prompt):
+        if self.initialized == False:
+            return None
+
+        # set instance grammar, if any choices provided
+        if newChoices != None:
+            self.set_choices(newChoices)
+
+        # start synthesis, if any prompt provided
+        if prompt != '':
+            await self.synthesize(prompt)
+
+        # wait for feedback
+        result = await self.read()
+
+        if prompt != '':
+            self.break_speech()
+
+        log_msg('grammar_prompt_and_read(): ' + result)
+
+        return result
+
+    async def start_dictation(self, endDictationToken, prompt):
+        if self.initialized == False:
+            return None
+
+        if prompt != '':
+            await self.synthesize(prompt)
+
+        self.send_command('startDictation', endDictationToken)
+
+        # get dictation result
+        result = await self.read()
+
+        # the engine drops its grammar when dictation ends, so send it again in full
+        self.queueHandler.grammarSync.reset()
+        self.queueHandler.grammarSync.request_update(self.instanceId)
+
+        log_msg('start_dictation(): ' + result)
+
+        return result
+
+# starts and stops the shell's apps: thread per app plus a coroutine loop
+# threaded apps (VIOSApp) get an OS thread each, which stays blocked while the
+#  app waits for input; nothing parks or reschedules them
+# coroutine apps (AsyncVIOSApp) are multiplexed on the QueueHandler's event
+#  loop, suspending at every read, so hundreds of them cost no threads; their
+#  blocking calls share a pool of worker threads (run_blocking)
+# shutdown() interrupts every app before joining any, so apps wind down in
+#  parallel within one timeout, then closes the QueueHandler
+class AppScheduler():
+    def __init__(self, queueHandler, workers = 4):
+        self.queueHandler = queueHandler
+        self.workers = workers
+
+        self.apps = []
+        self.lock = threading.Lock()
+
+        self.executor = None
+
+        metrics.add_collector(self.collect_metrics)
+
+    def start(self, app):
+        app.scheduler = self
+
+        with self.lock:
+            self.apps.append(app)
+
+        app.start()
+
+    def get_executor(self):
+        with self.lock:
+            if self.executor == None:
+                self.executor = concurrent.futures.ThreadPoolExecutor(self.workers, thread_name_prefix = 'vios-app')
+
+            return self.executor
+
+    # apps started and not yet finished
+    def running(self):
+        with self.lock:
+            return [app for app in self.apps if app.is_alive()]
+
+    # running apps as (threaded, coroutine) counts
+    def counts(self):
+        apps = self.running()
+        coroutines = len([app for app in apps if isinstance(app, AsyncVIOSApp)])
+
+        return len(apps) - coroutines, coroutines
+
+    # interrupts and wakes every running app, then waits up to timeout in total
+    #  for them to finish. Returns the apps still running
+    # closes the QueueHandler within the same timeout unless closeQueueHandler is
+    #  False, e.g. when the shell still has something to say
+    def shutdown(self, timeout = 5.0, closeQueueHandler = True):
+        apps = self.running()
+
+        for app in apps:
+            log_msg('Interrupting {0} ...'.format(app.name))
+            app.interrupted = True
+
+            if app.initialized:
+                self.queueHandler.wakeup(app.instanceId)
+
+        deadline = time.time() + timeout
+        for app in apps:
+            try:
+                app.join(max(0, deadline - time.time()))
+            except concurrent.futures.TimeoutError:
+                pass
+            except Exception as e:
+                # a coroutine app's join() re-raises whatever ended it
+                log_msg('{0} failed: {1}'.format(app.name, e), ERROR)
+
+        remaining = [app for app in apps if app.is_alive()]
+        for app in remaining:
+            log_msg('{0} did not exit within {1}s.'.format(app.name, timeout), WARNING)
+
+        with self.lock:
+            self.apps = remaining
+
+            if self.executor != None:
+                self.executor.shutdown(wait = False)
+                self.executor = None
+
+        if closeQueueHandler:
+            self.queueHandler.close(max(0, deadline - time.time()))
+
+        return remaining
+
+    def collect_metrics(self):
+        samples = []
+
+        counts = collections.Counter()
+        for app in self.running():
+            kind = 'coroutine' if isinstance(app, AsyncVIOSApp) else 'thread'
+            state = 'waiting' if app.waiting else 'busy'
+            counts[(kind, state)] += 1
+
+        for (kind, state), count in sorted(counts.items()):
+            samples.append(('vios_apps', 'gauge', { 'kind': kind, 'state': state }, count))
+
+        return samples
+
+# imports the module at path under name, once; later calls return the same module
+def load_module(name, path):
+    module = sys.modules.get(name)
+    if module != None:
+        return module
+
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+
+    sys.modules[name] = module
+    try:
+        spec.loader.exec_module(module)
+    except:
+        del sys.modules[name]
+        raise
+
+    return module
+
+# file in an app's directory describing it, e.g.
+#  { "name": "AudiPlay", "words": ["audiplay"], "module": "audiplay.py", "class": "AudiPlay" }
+APP_MANIFEST = 'app.json'
+
+# entry point group of installed apps; the entry point's name is the word that
+#  launches the app and its value the app class, e.g. 'myapp = mypackage.app:MyApp'
+APP_ENTRY_POINT_GROUP = 'vios.apps'
+
+# an app known by name and launch words, whose code is only imported by
+#  load_class()
+class AppPlugin():
+    def __init__(self, name, words, modulePath = None, className = None, entryPoint = None):
+        self.name = name
+        self.words = words
+
+        # a module file and class in it, or an importlib.metadata.EntryPoint
+        self.modulePath = modulePath
+        self.className = className
+        self.entryPoint = entryPoint
+
+        self.appClass = None
+
+    def load_class(self):
+        if self.appClass == None:
+            startTime = time.time()
+
+            if self.entryPoint != None:
+                self.appClass = self.entryPoint.load()
+            else:
+                moduleName = os.path.splitext(os.path.basename(self.modulePath))[0]
+                self.appClass = getattr(load_module(moduleName, self.modulePath), self.className)
+
+            elapsed = time.time() - startTime
+            metrics.observe('vios_app_load_seconds', elapsed, { 'app': self.name })
+            log_msg('Loaded {0} in {1:.0f}ms.'.format(self.name, elapsed * 1000))
+
+        return self.appClass
+
+# apps the shell can launch, found without importing them: from APP_MANIFEST
+#  files in the subdirectories of a directory, and from installed packages'
+#  APP_ENTRY_POINT_GROUP entry points
+# an app is imported and constructed the first time one of its words is chosen
+class PluginRegistry():
+    def __init__(self):
+        # word -> AppPlugin
+        self.plugins = collections.OrderedDict()
+
+        # app name -> instance, for apps created so far
+        self.instances = {}
+
+    def add(self, plugin):
+        for word in plugin.words:
+            if word in self.plugins:
+                log_msg('PluginRegistry: {0} and {1} both use the word {2!r}; keeping {0}.'.format(self.plugins[word].name,
+                                                                                               plugin.name,
+                                                                                               word), WARNING)
+            else:
+                self.plugins[word] = plugin
+
+    # reads the manifests of directory's subdirectories, in name order
+    def discover(self, directory):
+        for entry in sorted(os.scandir(directory), key = lambda entry: entry.name):
+            manifestPath = os.path.join(entry.path, APP_MANIFEST)
+            if not entry.is_dir() or not os.path.isfile(manifestPath):
+                continue
+
+            try:
+                with open(manifestPath) as manifestFile:
+                    manifest = json.load(manifestFile)
+
+                self.add(AppPlugin(manifest['name'],
+                                   [word.lower() for word in manifest.get('words', [manifest['name'].lower()])],
+                                   modulePath = os.path.join(entry.path, manifest['module']),
+                                   className = manifest['class']))
+            except (OSError, ValueError, KeyError) as e:
+                log_msg('PluginRegistry: skipping {0}: {1}'.format(manifestPath, e), WARNING)
+
+    def discover_entry_points(self, group = APP_ENTRY_POINT_GROUP):
+        try:
+            entryPoints = importlib.metadata.entry_points(group = group)
+        except TypeError:
+            # before Python 3.10, entry_points() returns a dict of groups
+            entryPoints = importlib.metadata.entry_points().get(group, [])
+
+        for entryPoint in entryPoints:
+            self.add(AppPlugin(entryPoint.name, [entryPoint.name.lower()], entryPoint = entryPoint))
+
+    # launch words of every app, for the shell's grammar
+    def words(self):
+        return list(self.plugins)
+
+    # the app a word launches, created on first use, or None
+    def get(self, word, queueHandler):
+        plugin = self.plugins.get(word)
+        if plugin == None:
+            return None
+
+        app = self.instances.get(plugin.name)
+        if app == None:
+            app = plugin.load_class()(queueHandler)
+            self.instances[plugin.name] = app
+
+        return app
+
+# returns True if called from the thread running loop
+def on_loop(loop):
+    try:
+        return asyncio.get_running_loop() is loop
+    except RuntimeError:
+        return False
+
+# frame length prefix used by both sides of the pipe
+FRAME_HEADER = struct.Struct('I')
+
+# builds a frame using simple protocol of length followed by msg
+def pack_frame(writeBytes):
+    return FRAME_HEADER.pack(len(writeBytes)) + writeBytes
+
+# reads msg bytes from an asyncio stream using simple protocol of length followed by msg
+async def read_frame(reader):
+    readBytes = await reader.readexactly(FRAME_HEADER.size)
+
+    frameLength = FRAME_HEADER.unpack(readBytes)[0]
+
+    return await reader.readexactly(frameLength)
+
+# resolves a future a mailbox coroutine reader is awaiting. Runs on the future's loop
+def wake_future(future):
+    if not future.done():
+        future.set_result(None)
+
+# Windows named pipes opened 'r+b' need a seek between reads and writes,
+#  but anonymous pipes and sockets used for local runs can't seek at all
+def seek_start(pipe):
+    if pipe.seekable():
+        pipe.seek(0)
+
+# writes msg to pipe using simple protocol of length followed by msg
+def pipe_write(pipe, writeString):
+    log_frame('>', writeString)
+
+    pipe_write_frame(pipe, writeString.encode('ascii'))
+
+# writes encoded msg bytes to pipe using simple protocol of length followed by msg
+def pipe_write_frame(pipe, writeBytes):
+    # write length followed by bytes
+    write_all(pipe, pack_frame(writeBytes))
+    seek_start(pipe)
+
+# reads whatever one OS read returns into view, waiting first if a nonblocking
+#  pipe has nothing available. Returns 0 once the pipe is closed
+def read_some(pipe, view):
+    # buffered pipes must not block trying to fill all of view
+    readinto = getattr(pipe, 'readinto1', pipe.readinto)
+
+    while True:
+        try:
+            count = readinto(view)
+        except BlockingIOError:
+            count = None
+
+        if count != None:
+            return count
+
+        wait_ready(pipe, selectors.EVENT_READ)
+
+# writes all of data, retrying partial writes and waiting on nonblocking pipes
+def write_all(pipe, data):
+    view = memoryview(data)
+
+    while len(view) > 0:
+        try:
+            count = pipe.write(view)
+        except BlockingIOError as e:
+            count = e.characters_written
+
+        if not count:
+            wait_ready(pipe, selectors.EVENT_WRITE)
+            continue
+
+        view = view[count:]
+
+    pipe.flush()
+
+# blocks until a nonblocking pipe or socket is ready for events
+def wait_ready(pipe, events):
+    with selectors.DefaultSelector() as selector:
+        selector.register(pipe.fileno(), events)
+        selector.select()
+
+# reads msg from pipe using simple protocol of length followed by msg
+def pipe_read(pipe):
+    # convert string
+    return pipe_read_frame(pipe).decode('ascii')
+
+# reads one frame's msg bytes from pipe using simple protocol of length followed by msg
+# for a stream of frames, FrameReader avoids the per-frame allocations and reads
+def pipe_read_frame(pipe):
+    header = read_exactly(pipe, bytearray(FRAME_HEADER.size))
+    if header == None:
+        raise NameError('Error on connection.')
+
+    payload = read_exactly(pipe, bytearray(FRAME_HEADER.unpack(header)[0]))
+    if payload == None:
+        log_msg('pipe_read_frame(): connection closed mid-frame.')
+        return b''
+
+    return bytes(payload)
+
+# fills buffer from pipe, returning None if the pipe closes first
+def read_exactly(pipe, buffer):
+    view = memoryview(buffer)
+
+    bytesRead = 0
+    while bytesRead < len(buffer):
+        count = read_some(pipe, view[bytesRead:])
+        if count == 0:
+            return None
+
+        bytesRead += count
+
+    return buffer
+
+# incrementally parses length-prefixed frames out of a reusable buffer
+# each readinto() can deliver several frames, or only part of one; complete
+#  frames are yielded as memoryview slices of the buffer, which are only valid
+#  until the next frame is requested
+class FrameReader():
+    def __init__(self, _pipe, bufferSize = 65536):
+        self.pipe = _pipe
+
+        self.buffer = bytearray(bufferSize)
+        self.view = memoryview(self.buffer)
+
+        # unparsed data lies in buffer[start:end]
+        self.start = 0
+        self.end = 0
+
+    # yields frame payloads until the pipe is closed
+    def frames(self):
+        while True:
+            # hand out every complete frame already buffered
+            while self.end - self.start >= FRAME_HEADER.size:
+                frameLength = FRAME_HEADER.unpack_from(self.buffer, self.start)[0]
+
+                frameEnd = self.start + FRAME_HEADER.size + frameLength
+                if frameEnd > self.end:
+                    break
+
+                yield self.view[self.start + FRAME_HEADER.size:frameEnd]
+
+                self.start = frameEnd
+
+            self.compact()
+
+            count = read_some(self.pipe, self.view[self.end:])
+            if count == 0:
+                if self.end > 0:
+                    log_msg('FrameReader: connection closed with {0} bytes of partial frame.'.format(self.end))
+                return
+
+            self.end += count
+
+    # moves a trailing partial frame to the front of the buffer, growing the
+    #  buffer if that frame won't fit
+    def compact(self):
+        remaining = self.end - self.start
+
+        if self.start > 0:
+            self.view[:remaining] = self.view[self.start:self.end]
+            self.start = 0
+            self.end = remaining
+
+        if remaining >= FRAME_HEADER.size:
+            frameSize = FRAME_HEADER.size + FRAME_HEADER.unpack_from(self.buffer, 0)[0]
+            if frameSize > len(self.buffer):
+                # a new buffer is needed since yielded slices may still pin this one
+                buffer = bytearray(frameSize)
+                buffer[:remaining] = self.view[:remaining]
+
+                self.buffer = buffer
+                self.view = memoryview(self.buffer)
+
+# connection to the audio engine. open() returns the (recvPipe, sendPipe) file
+#  objects QueueHandler reads and writes; open_server() returns the engine's end
+# buffering sets the size of a read buffer in front of recvPipe (0 reads raw).
+#  sendPipe is always unbuffered since QueueHandler's writer already coalesces
+# nonblocking puts the underlying descriptors in nonblocking mode; reads and
+#  writes then wait for readiness with selectors rather than blocking in the OS
+class Transport():
+    def __init__(self, buffering = 0, nonblocking = False):
+        self.buffering = buffering
+        self.nonblocking = nonblocking
+
+    def open(self):
+        raise NotImplementedError()
+
+    def open_server(self):
+        raise NotImplementedError()
+
+    # returns (StreamReader, StreamWriter) for AsyncQueueHandler
+    async def open_async(self):
+        raise NotImplementedError()
+
+    # opens a raw file descriptor with the configured read buffering
+    def open_reader(self, fd):
+        if self.buffering > 0:
+            return open(fd, 'rb', self.buffering)
+
+        return open(fd, 'rb', 0)
+
+# the .Net client's pair of Windows named pipes
+class NamedPipeTransport(Transport):
+    def __init__(self, recvName = r'\\.\pipe\NPToGE', sendName = r'\\.\pipe\NPFromGE', buffering = 0):
+        Transport.__init__(self, buffering)
+
+        self.recvName = recvName
+        self.sendName = sendName
+
+    def open(self):
+        # set up connection for VIOS input
+        recvPipe = open(self.recvName, 'r+b', self.buffering)
+        log_msg('Connected to named pipe for receiving ...')
+
+        # set up connection for VIOS output
+        sendPipe = open(self.sendName, 'r+b', 0)
+        log_msg('Connected to named pipe for sending ...')
+
+        return recvPipe, sendPipe
+
+# base for stream socket transports, one bidirectional connection
+# socketBuffer sets SO_RCVBUF/SO_SNDBUF when nonzero
+class SocketTransport(Transport):
+    def __init__(self, buffering = 0, nonblocking = False, socketBuffer = 0):
+        Transport.__init__(self, buffering, nonblocking)
+
+        self.socketBuffer = socketBuffer
+
+        self.listenSocket = None
+
+    def create_socket(self):
+        raise NotImplementedError()
+
+    def address(self):
+        raise NotImplementedError()
+
+    def configure(self, sock):
+        if self.socketBuffer > 0:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.socketBuffer)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.socketBuffer)
+
+    def make_pipes(self, sock):
+        self.configure(sock)
+
+        sock.setblocking(not self.nonblocking)
+
+        # socket file objects only support timeouts when buffered, so a
+        #  nonblocking socket is always read raw
+        if self.buffering > 0 and self.nonblocking == False:
+            recvPipe = sock.makefile('rb', self.buffering)
+        else:
+            recvPipe = sock.makefile('rb', 0)
+
+        return recvPipe, sock.makefile('wb', 0)
+
+    def open(self):
+        sock = self.create_socket()
+        sock.connect(self.address())
+
+        log_msg('Connected to {0}.'.format(self.address()))
+
+        return self.make_pipes(sock)
+
+    def listen(self):
+        self.listenSocket = self.create_socket()
+        self.listenSocket.bind(self.address())
+        self.listenSocket.listen(1)
+
+    # accepts a single connection from QueueHandler
+    def open_server(self):
+        if self.listenSocket == None:
+            self.listen()
+
+        sock, address = self.listenSocket.accept()
+
+        return self.make_pipes(sock)
+
+class UnixSocketTransport(SocketTransport):
+    def __init__(self, path, buffering = 0, nonblocking = False, socketBuffer = 0):
+        SocketTransport.__init__(self, buffering, nonblocking, socketBuffer)
+
+        self.path = path
+
+    def create_socket(self):
+        return socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    def address(self):
+        return self.path
+
+    def listen(self):
+        # remove a stale socket left by a previous engine
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+        SocketTransport.listen(self)
+
+    async def open_async(self):
+        return await asyncio.open_unix_connection(self.path, limit = max(self.buffering, 2 ** 16))
+
+# noDelay disables Nagle's algorithm, which otherwise holds back small frames
+class TcpTransport(SocketTransport):
+    def __init__(self, host, port, buffering = 0, nonblocking = False, socketBuffer = 0, noDelay = True):
+        SocketTransport.__init__(self, buffering, nonblocking, socketBuffer)
+
+        self.host = host
+        self.port = port
+        self.noDelay = noDelay
+
+    def create_socket(self):
+        return socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+    def address(self):
+        return (self.host, self.port)
+
+    def configure(self, sock):
+        SocketTransport.configure(self, sock)
+
+        if self.noDelay:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def listen(self):
+        SocketTransport.listen(self)
+
+        # pick up the actual port when listening on port 0
+        self.port = self.listenSocket.getsockname()[1]
+
+    async def open_async(self):
+        reader, writer = await asyncio.open_connection(self.host, self.port, limit = max(self.buffering, 2 ** 16))
+
+        if self.noDelay:
+            writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        return reader, writer
+
+# anonymous pipes, e.g. to an engine running as a child process
+# pipeSize resizes the kernel pipe buffer where supported (Linux F_SETPIPE_SZ)
+class PipeTransport(Transport):
+    def __init__(self, recvFd, sendFd, buffering = 0, nonblocking = False, pipeSize = 0):
+        Transport.__init__(self, buffering, nonblocking)
+
+        self.recvFd = recvFd
+        self.sendFd = sendFd
+        self.pipeSize = pipeSize
+
+    # returns (client, server) transports connected by two new pipes
+    @staticmethod
+    def pair(buffering = 0, nonblocking = False, pipeSize = 0):
+        toEngineRecv, toEngineSend = os.pipe()
+        fromEngineRecv, fromEngineSend = os.pipe()
+
+        return (PipeTransport(fromEngineRecv, toEngineSend, buffering, nonblocking, pipeSize),
+                PipeTransport(toEngineRecv, fromEngineSend, buffering, nonblocking, pipeSize))
+
+    def open(self):
+        for fd in (self.recvFd, self.sendFd):
+            if self.pipeSize > 0:
+                try:
+                    import fcntl
+                    fcntl.fcntl(fd, 1031, self.pipeSize) # F_SETPIPE_SZ
+                except (ImportError, OSError):
+                    log_msg('PipeTransport: could not set pipe size.')
+
+            os.set_blocking(fd, not self.nonblocking)
+
+        return self.open_reader(self.recvFd), open(self.sendFd, 'wb', 0)
+
+    # each end is just a pair of descriptors
+    def open_server(self):
+        return self.open()
+
+# builds a Transport from a spec such as
+#  'namedpipe:'
+#  'unix:///tmp/vios.sock?buffering=65536'
+#  'tcp://127.0.0.1:5555?nodelay=1&nonblocking=1'
+#  'pipe://3,4' (receive and send file descriptors)
+def make_transport(spec):
+    url = urllib.parse.urlsplit(spec)
+    options = dict(urllib.parse.parse_qsl(url.query))
+
+    buffering = int(options.get('buffering', 0))
+    nonblocking = options.get('nonblocking', '0') == '1'
+    socketBuffer = int(options.get('socketbuffer', 0))
+
+    scheme = url.scheme or url.path
+    if scheme == 'namedpipe':
+        return NamedPipeTransport(buffering = buffering)
+    elif scheme == 'unix':
+        return UnixSocketTransport(url.path, buffering, nonblocking, socketBuffer)
+    elif scheme == 'tcp':
+        return TcpTransport(url.hostname, url.port, buffering, nonblocking, socketBuffer,
+                            noDelay = options.get('nodelay', '1') == '1')
+    elif scheme == 'pipe':
+        recvFd, sendFd = url.netloc.split(',')
+        return PipeTransport(int(recvFd), int(sendFd), buffering, nonblocking,
+                             int(options.get('pipesize', 0)))
+
+    raise Exception('Unknown transport: ' + spec)
+
+# one directory's entries, as of the directory's mtime
+class DirectoryListing():
+    def __init__(self, mtime, subdirectories, files):
+        self.mtime = mtime
+        self.subdirectories = subdirectories
+        self.files = files
+
+        # when the mtime was last compared with the directory's
+        self.checkTime = time.time()
+
+# caches os.scandir() listings for app navigation, so prompt loops don't rescan
+#  a directory (and stat each entry) on every utterance
+# a listing is reused until the directory's mtime changes, checked at most once
+#  per revalidateAfter seconds; at most maxEntries listings are kept, least
+#  recently used first out
+# prefetch() scans a directory's children on a background thread so descending
+#  into one is instant
+class DirectoryCache():
+    def __init__(self, maxEntries = 256, revalidateAfter = 1.0):
+        self.maxEntries = maxEntries
+        self.revalidateAfter = revalidateAfter
+
+        # path -> DirectoryListing, most recently used last
+        self.listings = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+        self.prefetchQueue = queue.Queue()
+        self.prefetchThread = None
+
+    def subdirectories(self, path):
+        return self.get(path).subdirectories
+
+    # full paths of files whose names end with one of extensions
+    def files(self, path, extensions):
+        return [os.path.join(path, name) for name in self.get(path).files if name.endswith(extensions)]
+
+    def get(self, path):
+        with self.lock:
+            listing = self.listings.get(path)
+            if listing != None:
+                self.listings.move_to_end(path)
+
+        now = time.time()
+        if listing != None and now - listing.checkTime < self.revalidateAfter:
+            metrics.inc('vios_directory_cache_total', { 'result': 'hit' })
+            return listing
+
+        mtime = os.stat(path).st_mtime_ns
+        if listing != None and listing.mtime == mtime:
+            listing.checkTime = now
+            metrics.inc('vios_directory_cache_total', { 'result': 'revalidated' })
+            return listing
+
+        metrics.inc('vios_directory_cache_total', { 'result': 'miss' })
+        return self.scan(path, mtime)
+
+    def scan(self, path, mtime):
+        subdirectories = []
+        files = []
+        with os.scandir(path) as entries:
+            for entry in entries:
+                # is_dir() uses the type scandir already read, so no stat per entry
+                if entry.is_dir():
+                    if entry.name != '__pycache__':
+                        subdirectories.append(entry.name)
+                else:
+                    files.append(entry.name)
+
+        listing = DirectoryListing(mtime, tuple(subdirectories), tuple(files))
+
+        with self.lock:
+            self.listings[path] = listing
+            self.listings.move_to_end(path)
+
+            while len(self.listings) > self.maxEntries:
+                self.listings.popitem(last = False)
+
+        return listing
+
+    # forgets path, e.g. after changing it within the filesystem's mtime resolution
+    def invalidate(self, path):
+        with self.lock:
+            self.listings.pop(path, None)
+
+    # scans path's subdirectories in the background
+    def prefetch(self, path):
+        with self.lock:
+            if self.prefetchThread == None:
+                self.prefetchThread = threading.Thread(target = self.process_prefetches)
+                self.prefetchThread.daemon = True
+                self.prefetchThread.start()
+
+        self.prefetchQueue.put(path)
+
+    def process_prefetches(self):
+        while True:
+            path = self.prefetchQueue.get()
+
+            try:
+                for name in self.get(path).subdirectories:
+                    childPath = os.path.join(path, name)
+                    with self.lock:
+                        cached = childPath in self.listings
+
+                    if not cached:
+                        self.get(childPath)
+
+                # keep the directory being browsed ahead of its children in the LRU
+                with self.lock:
+                    if path in self.listings:
+                        self.listings.move_to_end(path)
+            except OSError as e:
+                log_msg('DirectoryCache: could not prefetch {0}: {1}'.format(path, e), DEBUG)
+
+# shared by every app
+directoryCache = DirectoryCache()
+
+# where VIOS keeps its files, e.g. app databases; $VIOS_DATA, or ~/.vios
+def data_directory():
+    path = os.environ.get('VIOS_DATA', os.path.join(os.path.expanduser('~'), '.vios'))
+    os.makedirs(path, exist_ok = True)
+
+    return path
+
+# audio of prompts rendered by the engine ('speechRender'), so a prompt heard
+#  before plays from a file ('promptPlay') instead of being synthesized again
+# files are named by a hash of voice and text and kept across runs; at most
+#  maxEntries are kept, least recently used first out
+# a text is rendered when an app lists it in its prompts, or the second time
+#  it's synthesized, so one-off texts such as track descriptions aren't
+#  rendered at all. Renders run one at a time on a background thread
+class PromptCache():
+    def __init__(self, queueHandler, directory, voice = 'default', maxEntries = 256, renderTimeout = 10.0):
+        self.queueHandler = queueHandler
+        self.directory = directory
+        self.voice = voice
+        self.maxEntries = maxEntries
+        self.renderTimeout = renderTimeout
+
+        # speechRender args are 'path,text' and the engine splits them at the
+        #  first comma, so the path can't contain one
+        if ',' in directory:
+            raise ValueError('prompt cache directory {0!r} contains a comma'.format(directory))
+
+        os.makedirs(directory, exist_ok = True)
+
+        # key -> rendered file path, most recently used last
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+        # files from earlier runs, oldest first
+        rendered = []
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.name.endswith('.wav'):
+                    rendered.append((entry.stat().st_mtime_ns, entry.name[:-4], entry.path))
+
+        for mtime, key, path in sorted(rendered):
+            self.entries[key] = path
+
+        self.evict()
+
+        # keys synthesized once but not rendered, most recent last
+        self.seen = collections.OrderedDict()
+
+        # keys queued or being rendered
+        self.rendering = set()
+
+        self.renderQueue = queue.Queue()
+        self.renderThread = None
+
+        # replies to renders are routed here rather than to an app
+        self.mailbox = Mailbox()
+
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, text):
+        return hashlib.sha1('{0}\n{1}'.format(self.voice, text).encode('utf-8')).hexdigest()
+
+    # rendered file of text, or None; a miss may queue text for rendering
+    def lookup(self, text):
+        if text == '':
+            return None
+
+        key = self.key(text)
+
+        with self.lock:
+            path = self.entries.get(key)
+            if path != None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                metrics.inc('vios_prompt_cache_total', { 'result': 'hit' })
+                return path
+
+            self.misses += 1
+            metrics.inc('vios_prompt_cache_total', { 'result': 'miss' })
+
+            # render texts on their second use
+            if key in self.seen:
+                del self.seen[key]
+            else:
+                self.seen[key] = True
+                while len(self.seen) > self.maxEntries * 4:
+                    self.seen.popitem(last = False)
+                return None
+
+        self.render(key, text)
+
+        return None
+
+    # whether text is rendered, without counting a lookup
+    def contains(self, text):
+        with self.lock:
+            return self.key(text) in self.entries
+
+    # renders texts that aren't cached yet, e.g. an app's prompts at startup
+    def prewarm(self, texts):
+        for text in texts:
+            key = self.key(text)
+
+            with self.lock:
+                cached = key in self.entries
+
+            if not cached:
+                self.render(key, text)
+
+    def hit_rate(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+
+            if lookups == 0:
+                return None
+
+            return self.hits / lookups
+
+    def render(self, key, text):
+        with self.lock:
+            if key in self.rendering:
+                return
+
+            self.rendering.add(key)
+
+            if self.renderThread == None:
+                self.renderThread = threading.Thread(target = self.process_renders)
+                self.renderThread.daemon = True
+                self.renderThread.start()
+
+        self.renderQueue.put((key, text))
+
+    def process_renders(self):
+        while True:
+            key, text = self.renderQueue.get()
+
+            path = os.path.join(self.directory, key + '.wav')
+
+            # the text goes last, as it may contain commas; the path can't
+            command = Message('0', 'speechRender', self.queueHandler.get_message_id(), '{0},{1}'.format(path, text))
+            completion = self.queueHandler.register_completion(command, self.mailbox)
+
+            self.queueHandler.write(command)
+
+            reply = completion.wait(self.renderTimeout)
+            if reply == None:
+                self.queueHandler.instanceLock.acquire()
+                self.queueHandler.pendingDict.pop(command.messageId, None)
+                self.queueHandler.instanceLock.release()
+
+            with self.lock:
+                self.rendering.discard(key)
+
+                if reply == 'render done':
+                    self.entries[key] = path
+                    self.evict()
+
+            if reply != 'render done':
+                log_msg('PromptCache: could not render {0!r}: {1}'.format(text, reply), WARNING)
+
+    # caller holds lock, or is the constructor
+    def evict(self):
+        while len(self.entries) > self.maxEntries:
+            key, path = self.entries.popitem(last = False)
+
+            try:
+                os.remove(path)
+            except OSError:
+                pass
 
 # waits for yes/no (or break)
 def pipe_wait_for_confirm(queueHandler, command):
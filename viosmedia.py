@@ -0,0 +1,315 @@
+import os
+import struct
+
+# reads duration, title and artist from audio file headers without decoding audio
+# functions here run in worker processes, so they only use the standard library
+#  and return plain tuples
+
+# bytes read from the start of a file; tags and headers that matter live there
+HEAD_SIZE = 256 * 1024
+
+# bitrates in kbps by [version is MPEG-1][layer index], index 0 is 'free'
+MP3_BITRATES = {
+    (True, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+    (True, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    (True, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    (False, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    (False, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    (False, 3): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+
+# sample rates by MPEG version bits
+MP3_SAMPLE_RATES = { 3: [44100, 48000, 32000], 2: [22050, 24000, 16000], 0: [11025, 12000, 8000] }
+
+# returns (path, mtime, size, duration in seconds, title, artist) for each path
+# fields that can't be determined are None, as is everything but path if the
+#  file can't be read
+def read_media_infos(paths):
+    return [read_media_info(path) for path in paths]
+
+def read_media_info(path):
+    try:
+        stat = os.stat(path)
+        with open(path, 'rb') as mediaFile:
+            head = mediaFile.read(HEAD_SIZE)
+
+            # the last 128 bytes, where an ID3v1 tag would be
+            tail = head[-128:]
+            if stat.st_size > len(head):
+                mediaFile.seek(stat.st_size - 128)
+                tail = mediaFile.read(128)
+    except OSError:
+        return path, None, None, None, None, None
+
+    duration, title, artist = None, None, None
+    try:
+        if head[0:4] == b'RIFF' and head[8:12] == b'WAVE':
+            duration, title, artist = read_wav(head, stat.st_size)
+        elif head[4:8] == b'ftyp':
+            duration, title, artist = read_mp4(path)
+        else:
+            duration, title, artist = read_mp3(head, tail, stat.st_size)
+    except (struct.error, ValueError, IndexError, OSError):
+        # malformed header; report what the file system knows
+        pass
+
+    return path, stat.st_mtime_ns, stat.st_size, duration, title, artist
+
+# RIFF chunks: 'fmt ' gives the byte rate, 'data' the audio size and an
+#  optional LIST/INFO chunk holds INAM (title) and IART (artist)
+def read_wav(head, fileSize):
+    byteRate = None
+    dataSize = None
+    title = None
+    artist = None
+
+    offset = 12
+    while offset + 8 <= len(head):
+        chunkId = head[offset:offset + 4]
+        chunkSize, = struct.unpack_from('<I', head, offset + 4)
+        body = offset + 8
+
+        if chunkId == b'fmt ':
+            byteRate, = struct.unpack_from('<I', head, body + 8)
+        elif chunkId == b'data':
+            # the data chunk usually runs past what was read, and may be
+            #  truncated in files that were never finalized
+            dataSize = min(chunkSize, fileSize - body)
+        elif chunkId == b'LIST' and head[body:body + 4] == b'INFO':
+            infoOffset = body + 4
+            while infoOffset + 8 <= min(body + chunkSize, len(head)):
+                infoId = head[infoOffset:infoOffset + 4]
+                infoSize, = struct.unpack_from('<I', head, infoOffset + 4)
+                value = decode_text(head[infoOffset + 8:infoOffset + 8 + infoSize])
+
+                if infoId == b'INAM':
+                    title = value
+                elif infoId == b'IART':
+                    artist = value
+
+                infoOffset += 8 + infoSize + (infoSize & 1)
+
+        # chunks are word aligned
+        offset = body + chunkSize + (chunkSize & 1)
+
+    duration = None
+    if byteRate and dataSize != None:
+        duration = dataSize / byteRate
+
+    return duration, title, artist
+
+# ID3v2 frames (TIT2, TPE1, TLEN) or an ID3v1 tag for text, and the first frame
+#  header (with a Xing/Info frame count if present) for duration
+def read_mp3(head, tail, fileSize):
+    title = None
+    artist = None
+    duration = None
+
+    audioStart = 0
+    if head[0:3] == b'ID3':
+        version = head[3]
+        tagSize = synchsafe(head[6:10])
+        audioStart = 10 + tagSize
+
+        offset = 10
+        while offset + 10 <= min(audioStart, len(head)):
+            frameId = head[offset:offset + 4]
+            if frameId[0:1] == b'\x00':
+                break
+
+            if version >= 4:
+                frameSize = synchsafe(head[offset + 4:offset + 8])
+            else:
+                frameSize, = struct.unpack_from('>I', head, offset + 4)
+
+            frameBody = head[offset + 10:offset + 10 + frameSize]
+            if frameId == b'TIT2':
+                title = decode_id3_text(frameBody)
+            elif frameId == b'TPE1':
+                artist = decode_id3_text(frameBody)
+            elif frameId == b'TLEN':
+                length = decode_id3_text(frameBody)
+                if length and length.isdigit():
+                    duration = int(length) / 1000
+
+            offset += 10 + frameSize
+
+    audioEnd = fileSize
+    if len(tail) == 128 and tail[0:3] == b'TAG':
+        title = title or decode_text(tail[3:33])
+        artist = artist or decode_text(tail[33:63])
+        audioEnd -= 128
+
+    if duration == None:
+        duration = mp3_duration(head, audioStart, audioEnd)
+
+    return duration, title, artist
+
+def mp3_duration(head, audioStart, audioEnd):
+    # find the first frame sync after any tag
+    offset = head.find(b'\xff', audioStart)
+    while offset != -1 and offset + 4 <= len(head):
+        header, = struct.unpack_from('>I', head, offset)
+        if (header >> 21) & 0x7ff == 0x7ff:
+            versionBits = (header >> 19) & 3
+            layerBits = (header >> 17) & 3
+            bitrateIndex = (header >> 12) & 0xf
+            rateIndex = (header >> 10) & 3
+
+            if versionBits != 1 and layerBits != 0 and 0 < bitrateIndex < 15 and rateIndex < 3:
+                break
+
+        offset = head.find(b'\xff', offset + 1)
+    else:
+        return None
+
+    mpeg1 = versionBits == 3
+    layer = 4 - layerBits
+    sampleRate = MP3_SAMPLE_RATES[versionBits][rateIndex]
+    bitrate = MP3_BITRATES[(mpeg1, layer)][bitrateIndex] * 1000
+
+    samplesPerFrame = 1152
+    if layer == 1:
+        samplesPerFrame = 384
+    elif layer == 3 and not mpeg1:
+        samplesPerFrame = 576
+
+    # a Xing or Info header in the first frame gives the frame count of VBR files
+    channelMode = (header >> 6) & 3
+    if mpeg1:
+        sideInfo = 17 if channelMode == 3 else 32
+    else:
+        sideInfo = 9 if channelMode == 3 else 17
+
+    xing = offset + 4 + sideInfo
+    if head[xing:xing + 4] in (b'Xing', b'Info'):
+        flags, = struct.unpack_from('>I', head, xing + 4)
+        if flags & 1:
+            frames, = struct.unpack_from('>I', head, xing + 8)
+            return frames * samplesPerFrame / sampleRate
+
+    # otherwise assume a constant bitrate
+    return (audioEnd - offset) * 8 / bitrate
+
+# the movie header ('moov'/'mvhd') gives duration, iTunes-style metadata
+#  ('moov'/'udta'/'meta'/'ilst') gives title and artist
+def read_mp4(path):
+    with open(path, 'rb') as mediaFile:
+        moov = find_atom(mediaFile, 0, os.fstat(mediaFile.fileno()).st_size, b'moov')
+        if moov == None:
+            return None, None, None
+
+        mediaFile.seek(moov[0])
+        data = mediaFile.read(min(moov[1] - moov[0], 16 * 1024 * 1024))
+
+    duration = None
+    title = None
+    artist = None
+
+    for atomType, start, end in iterate_atoms(data, 0, len(data)):
+        if atomType == b'mvhd':
+            version = data[start]
+            if version == 1:
+                timescale, length = struct.unpack_from('>IQ', data, start + 20)
+            else:
+                timescale, length = struct.unpack_from('>II', data, start + 12)
+
+            if timescale:
+                duration = length / timescale
+        elif atomType == b'udta':
+            for metaType, metaStart, metaEnd in iterate_atoms(data, start, end):
+                if metaType != b'meta':
+                    continue
+
+                # 'meta' is a full atom with 4 bytes of version and flags
+                for listType, listStart, listEnd in iterate_atoms(data, metaStart + 4, metaEnd):
+                    if listType != b'ilst':
+                        continue
+
+                    for tagType, tagStart, tagEnd in iterate_atoms(data, listStart, listEnd):
+                        # each tag holds a 'data' atom: 8 bytes of type and locale, then the value
+                        for dataType, dataStart, dataEnd in iterate_atoms(data, tagStart, tagEnd):
+                            if dataType == b'data':
+                                value = decode_text(data[dataStart + 8:dataEnd])
+                                if tagType == b'\xa9nam':
+                                    title = value
+                                elif tagType == b'\xa9ART':
+                                    artist = value
+
+    return duration, title, artist
+
+# yields (type, body start, body end) for atoms in data[start:end]
+def iterate_atoms(data, start, end):
+    offset = start
+    while offset + 8 <= end:
+        size, atomType = struct.unpack_from('>I4s', data, offset)
+        header = 8
+        if size == 1:
+            size, = struct.unpack_from('>Q', data, offset + 8)
+            header = 16
+        elif size == 0:
+            size = end - offset
+
+        if size < header:
+            return
+
+        yield atomType, offset + header, min(offset + size, end)
+
+        offset += size
+
+# returns (body start, body end) of the top-level atom of atomType, reading
+#  only atom headers
+def find_atom(mediaFile, start, end, atomType):
+    offset = start
+    while offset + 8 <= end:
+        mediaFile.seek(offset)
+        header = mediaFile.read(16)
+        if len(header) < 8:
+            return None
+
+        size, currentType = struct.unpack_from('>I4s', header)
+        headerSize = 8
+        if size == 1:
+            size, = struct.unpack_from('>Q', header, 8)
+            headerSize = 16
+        elif size == 0:
+            size = end - offset
+
+        if size < headerSize:
+            return None
+
+        if currentType == atomType:
+            return offset + headerSize, offset + size
+
+        offset += size
+
+    return None
+
+def synchsafe(data):
+    return (data[0] << 21) | (data[1] << 14) | (data[2] << 7) | data[3]
+
+# ID3v2 text frames start with an encoding byte
+def decode_id3_text(body):
+    if len(body) == 0:
+        return None
+
+    encoding = body[0]
+    text = body[1:]
+    if encoding == 1:
+        value = text.decode('utf-16', 'replace')
+    elif encoding == 2:
+        value = text.decode('utf-16-be', 'replace')
+    elif encoding == 3:
+        value = text.decode('utf-8', 'replace')
+    else:
+        value = text.decode('latin-1')
+
+    return value.strip('\x00').strip() or None
+
+def decode_text(data):
+    try:
+        value = data.decode('utf-8')
+    except UnicodeDecodeError:
+        value = data.decode('latin-1')
+
+    return value.strip('\x00').strip() or None